@@ -0,0 +1,112 @@
+import sys
+import os
+import time
+import random
+import numpy as np
+from types import SimpleNamespace
+from sdl2 import SDL_SCANCODE_RIGHT, SDL_SCANCODE_X
+from cavestory import PATHNAME, GLOBAL, STARTUP, HEADLESS_SCRIPT, Vector2, Rectangle, Slope, Tile, Sprite, AnimatedSprite, Player, HeadlessGraphics, HeadlessGame, \
+    SnapshotRing, createLevel, expandInputScript
+
+ALLOCATION = SimpleNamespace(FRAMES = 2000, RETAINED_LIMIT = 512) #RETAINED_LIMIT in bytes over the whole run, so even one small object a frame exceeds it
+
+
+def benchmarkTileCollisions(mapName, queries = 100000):
+    level = createLevel(mapName, Vector2(100, 100), HeadlessGraphics())
+    if not level.usesTileGrid():
+        raise ValueError(mapName + " has no tile attribute grid")
+
+    random.seed(0)
+    mapWidth = level._size.x * level._tileSize.x * GLOBAL.SPRITE_SCALE
+    mapHeight = level._size.y * level._tileSize.y * GLOBAL.SPRITE_SCALE
+    boxes = [Rectangle(random.randrange(0, mapWidth), random.randrange(0, mapHeight), 32, 32) for i in range(0, queries)]
+
+    start = time.perf_counter()
+    for box in boxes:
+        level.checkTileCollisions(box)
+    rectangleTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for box in boxes:
+        level.checkTileGridCollisions(box)
+    gridTime = time.perf_counter() - start
+    return rectangleTime / queries, gridTime / queries
+
+def benchmarkSnapshots(mapName, iterations = 10000):
+    script = [(30, (SDL_SCANCODE_RIGHT, SDL_SCANCODE_X))] + HEADLESS_SCRIPT
+    game = HeadlessGame(mapName)
+    game.run(script, 300)
+    ring = SnapshotRing(game)
+
+    start = time.perf_counter()
+    for i in range(0, iterations):
+        ring.push(game)
+    captureTime = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    for i in range(0, iterations):
+        ring._layout.restore(game, ring._data[0])
+    restoreTime = (time.perf_counter() - start) / iterations
+
+    #Running the same input from a restored snapshot has to land in the same place
+    keys = expandInputScript(script, 600)[300:]
+    runs = np.zeros((2, ring.getSize()), dtype = np.uint8)
+    for run in runs:
+        ring.restart(game)
+        for held in keys:
+            game.step(held)
+        ring._layout.capture(game, run)
+    return ring.getSize(), captureTime, restoreTime, bool((runs[0] == runs[1]).all())
+
+def benchmarkStartup(runs = STARTUP.RUNS):
+    import subprocess
+    def timeProcess(command):
+        start = time.perf_counter()
+        output = subprocess.run(command, cwd = PATHNAME, stdout = subprocess.PIPE, check = True, universal_newlines = True).stdout
+        return time.perf_counter() - start, output
+
+    #Fresh processes each run, so nothing is warm but the OS file cache
+    interpreter, imports, firstFrames, processes = [], [], [], []
+    for i in range(0, runs):
+        interpreter.append(timeProcess([sys.executable, "-c", "pass"])[0])
+        imports.append(timeProcess([sys.executable, "-c", "import cavestory"])[0])
+        elapsed, output = timeProcess([sys.executable, os.path.join(PATHNAME, "cavestory.py"), "--first-frame"])
+        processes.append(elapsed)
+        firstFrames.append(float(output.split()[-2]))
+    return float(np.median(interpreter)), float(np.median(imports)), float(np.median(firstFrames)), float(np.median(processes))
+
+def measureFrameAllocations(mapName, frames = 500, warmup = 300, firing = True):
+    import tracemalloc
+    game = HeadlessGame(mapName)
+    keys = expandInputScript(HEADLESS_SCRIPT, warmup + frames)
+    #Holding fire keeps bullets spawning, hitting walls and leaving carets, so the pools are measured too
+    if firing:
+        keys = [held + (SDL_SCANCODE_X,) for held in keys]
+
+    #Count constructor calls for transient objects and diff traced memory for anything a frame keeps alive
+    constructors = {cls.__init__.__code__ for cls in (Vector2, Rectangle, Slope, Tile, Sprite, AnimatedSprite, Player)}
+    created = []
+    def profile(frame, event, arg):
+        if event == "call" and frame.f_code in constructors:
+            created.append(type(frame.f_locals["self"]).__name__)
+
+    sourceFilter = [tracemalloc.Filter(True, Sprite.__init__.__code__.co_filename)]
+    tracemalloc.start()
+    sys.setprofile(profile)
+    try:
+        #Warm up under the profiler too, so one-off interpreter caches are not counted as per-frame growth
+        for i in range(0, warmup):
+            game.step(keys[i])
+            game.draw(game._graphics)
+        created.clear()
+
+        before = tracemalloc.take_snapshot().filter_traces(sourceFilter)
+        for i in range(warmup, warmup + frames):
+            game.step(keys[i])
+            game.draw(game._graphics)
+    finally:
+        sys.setprofile(None)
+    after = tracemalloc.take_snapshot().filter_traces(sourceFilter)
+    tracemalloc.stop()
+
+    retained = sum(stat.size_diff for stat in after.compare_to(before, "lineno") if stat.size_diff > 0)
+    return created, retained
@@ -1,24 +1,73 @@
 import sys
 import os
 import math
+import mmap
+import array
+import struct
+import time
+import argparse
+import json
+import base64
+import gzip
+import threading
+import zlib
+import importlib.util
 import sdl2
-#import sdl2.sdlimage
-import sdl2.ext
-import untangle
 import traceback
 #import pytinyxml2
 from enum import Enum
-from ctypes import byref, POINTER, c_int
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import byref, POINTER, c_char, c_int, c_uint8
 from types import SimpleNamespace
 from sdl2 import *
 
+def lazyImport(name):
+    #The module is only executed when one of its attributes is first used
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+np = lazyImport("numpy")
+
 FPS = 50
 MAX_FRAME_TIME = 5 * 1000 / FPS
+LOOP = SimpleNamespace(VSYNC = False, RENDER_FPS = FPS, FIXED_UPDATE = False, SLEEP_MARGIN_MS = 1) #RENDER_FPS None for uncapped; FIXED_UPDATE steps 1000 / FPS and interpolates the draw
 
 GLOBAL = SimpleNamespace(SCREEN_WIDTH = 640, SCREEN_HEIGHT = 480, SPRITE_SCALE = 2) #640, 480
+LEVEL_HOTKEYS = {SDL_SCANCODE_1: "Map 1", SDL_SCANCODE_2: "Map 2"}
+REPLAY_KEYS = (SDL_SCANCODE_LEFT, SDL_SCANCODE_RIGHT, SDL_SCANCODE_UP, SDL_SCANCODE_DOWN, SDL_SCANCODE_Z, SDL_SCANCODE_X, SDL_SCANCODE_1, SDL_SCANCODE_2) #bit order of recorded key masks
+COLLISION = SimpleNamespace(TILE_GRID = True) #resolve PXA-based stages against their attribute grid instead of collision rectangles
+RENDER = SimpleNamespace(BAKE_LAYERS = True, CHUNK_TILES = 16, BAKE_CHUNKS_PER_FRAME = 1, BATCH = True, BATCH_CAPACITY = 2048, TEXTURE_BUDGET = 64 * 1024 * 1024) #TEXTURE_BUDGET in bytes, None for no limit
+PLAYER_ANIMATION = SimpleNamespace(IDLE_LEFT = 0, IDLE_RIGHT = 1, RUN_LEFT = 2, RUN_RIGHT = 3) #order of buildPlayerAnimations
+BULLET_ANIMATION = SimpleNamespace(MACHINE_GUN_LEFT = 0, MACHINE_GUN_UP = 1, MACHINE_GUN_RIGHT = 2, MACHINE_GUN_DOWN = 3) #order of buildBulletAnimations
+CARET_ANIMATION = SimpleNamespace(SHOOT = 0, WALL_HIT = 1) #order of buildCaretAnimations
 PLAYER_CONSTANTS = SimpleNamespace(WALK_SPEED = 0.2, JUMP_SPEED = 0.7, GRAVITY = 0.002, GRAVITY_CAP = 0.8) #.2, .7, .002, .8
 
-PATHNAME = os.path.abspath(os.path.dirname(sys.argv[0]))
+PATHNAME = os.path.dirname(os.path.abspath(__file__))
+
+NPC = SimpleNamespace(TABLE_PATH = PATHNAME + "/../data/npc.tbl", CAPACITY = 256, GRAVITY = PLAYER_CONSTANTS.GRAVITY, GRAVITY_CAP = PLAYER_CONSTANTS.GRAVITY_CAP, FRAME_TIME = 100)
+STAGE = SimpleNamespace(DIRECTORY = PATHNAME + "/../data/Stage/", PXM_MAGIC = b"PXM\x10", PXE_MAGIC = b"PXE\x00", TILE_SIZE = 16, TILESET_COLUMNS = 16, DOOR_NPC = 18)
+TSC = SimpleNamespace(MAGIC = b"PCTS", VERSION = 1, HEADER = struct.Struct("<4sIqIII"), DIRECTORY = PATHNAME + "/../data/", CACHE_DIRECTORY = PATHNAME + "/../cache/scripts/", ENCODING = "cp932", FLAG_COUNT = 8000, OPCODES_PER_UPDATE = 64)
+REPLAY = SimpleNamespace(MAGIC = b"PCRP", VERSION = 2, HEADER = struct.Struct("<4sIIdB"), FINAL_STATE = struct.Struct("<ddddB"), RECORD_PATH = None, TOLERANCE = 1e-6)
+STARTUP = SimpleNamespace(RUNS = 5, FIRST_FRAME_ONLY = False, STARTED = 0.0) #STARTED is the perf_counter() value main() began at
+SNAPSHOT = SimpleNamespace(HISTORY = 250, PLAYER = struct.Struct("<7d3i4B"), WORLD = struct.Struct("<dI"), REWIND_KEY = SDL_SCANCODE_BACKSPACE, RESTART_KEY = SDL_SCANCODE_R) #HISTORY in frames
+PROFILE = SimpleNamespace(ENABLED = False, OVERLAY = False, TRACE_PATH = None, TRACE_FLUSH = 4096, HISTORY = 300, OVERLAY_SCALE = 20) #OVERLAY_SCALE in pixels per millisecond; TRACE_FLUSH in buffered trace events
+PROJECTILE = SimpleNamespace(CAPACITY = 64, CARET_CAPACITY = 64, SPEED = 0.8, LIFETIME = 400, FIRE_INTERVAL = 100, FRAME_TIME = 40, CARET_FRAME_TIME = 60,
+                             BULLET_PATH = PATHNAME + "/../data/Bullet.pbm", CARET_PATH = PATHNAME + "/../data/Caret.pbm") #SPEED in pixels per millisecond, times in milliseconds
+PACK = SimpleNamespace(MAGIC = b"PCPK", VERSION = 1, HEADER = struct.Struct("<4sIIII"), ENTRY = struct.Struct("<QQI"), ALIGNMENT = 16, ROOT = os.path.abspath(PATHNAME + "/.."), DIRECTORIES = ("data", "Resources"), PATH = PATHNAME + "/../assets.pack")
+ATLAS = SimpleNamespace(MAGIC = b"PCAT", VERSION = 2, HEADER = struct.Struct("<4sIIII"), SHEET = struct.Struct("<IIHHHH"), PAGE_SIZE = 1024, PADDING = 2, PATH = PATHNAME + "/../cache/atlas.bin",
+                        SHEETS = ("data/Npc/*.pbm", "data/MyChar.pbm", "data/Arms.pbm", "data/Bullet.pbm", "data/Caret.pbm", "Resources/sprites/*.png")) #SHEETS are patterns relative to PACK.ROOT
+BACKGROUND = SimpleNamespace(DIRECTORY = PATHNAME + "/../data/", MAP_PATH = PATHNAME + "/../Resources/backgrounds/bkBlue.png", SCROLL_SPEED = 0.05) #SCROLL_SPEED in sheet pixels per millisecond per auto-scroll factor
+STAGE_PREPROCESS = SimpleNamespace(VERSION = 2, DIRECTORY = PATHNAME + "/../cache/stages/")
+TMX = SimpleNamespace(GID_MASK = 0x1FFFFFFF) #the top three gid bits are Tiled's flip flags
+LEVEL_CACHE = SimpleNamespace(MAGIC = b"PCLV", VERSION = 2, HEADER = struct.Struct("<4s11I"), MAPS_DIRECTORY = PATHNAME + "/../Resources/maps/", DIRECTORY = PATHNAME + "/../cache/levels/")
 
 class Side(Enum):
     TOP = 0
@@ -40,6 +89,91 @@ def getOppositeSide(side):
     else:
         return Side.NONE
 
+TILE_CLASS = SimpleNamespace(NONE = 0, SOLID = 1, FLOOR_SLOPE = 2, CEILING_SLOPE = 3, SPIKE = 4)
+
+_tileClassTable = None
+
+def getTileClassTable():
+    global _tileClassTable
+    if _tileClassTable is None:
+        table = np.zeros(256, dtype = np.uint8)
+        table[[0x05, 0x41, 0x43, 0x46, 0x61]] = TILE_CLASS.SOLID
+        table[[0x42, 0x62]] = TILE_CLASS.SPIKE
+        table[0x50:0x54] = TILE_CLASS.CEILING_SLOPE
+        table[0x70:0x74] = TILE_CLASS.CEILING_SLOPE
+        table[0x54:0x58] = TILE_CLASS.FLOOR_SLOPE
+        table[0x74:0x78] = TILE_CLASS.FLOOR_SLOPE
+        _tileClassTable = table
+    return _tileClassTable
+
+#Height of a slope's surface at the left and right edge of its tile, indexed by attribute & 7
+SLOPE_LINES = [(16, 8), (8, 0), (0, 8), (8, 16), (0, 8), (8, 16), (16, 8), (8, 0)]
+
+TSC_ARGUMENT_COUNTS = {
+    "AE+": 0, "AM+": 2, "AM-": 1, "AMJ": 2, "ANP": 3, "BOA": 1, "BSL": 1, "CAT": 0, "CIL": 0, "CLO": 0, "CLR": 0, "CMP": 3,
+    "CMU": 1, "CNP": 3, "CPS": 0, "CRE": 0, "CSS": 0, "DNA": 1, "DNP": 1, "ECJ": 2, "END": 0, "EQ+": 1, "EQ-": 1, "ESC": 0,
+    "EVE": 1, "FAC": 1, "FAI": 1, "FAO": 1, "FL+": 1, "FL-": 1, "FLA": 0, "FLJ": 2, "FMU": 0, "FOB": 2, "FOM": 1, "FON": 2,
+    "FRE": 0, "GIT": 1, "HMC": 0, "INI": 0, "INP": 3, "IT+": 1, "IT-": 1, "ITJ": 2, "KEY": 0, "LDP": 0, "LI+": 1, "ML+": 1,
+    "MLP": 0, "MM0": 0, "MNA": 0, "MNP": 4, "MOV": 2, "MP+": 1, "MPJ": 1, "MS2": 0, "MS3": 0, "MSG": 0, "MYB": 1, "MYD": 1,
+    "NCJ": 2, "NOD": 0, "NUM": 1, "PRI": 0, "PS+": 2, "QUA": 1, "RMU": 0, "SAT": 0, "SIL": 1, "SK+": 1, "SK-": 1, "SKJ": 2,
+    "SLP": 0, "SMC": 0, "SMP": 2, "SNP": 4, "SOU": 1, "SPS": 0, "SSS": 1, "STC": 0, "SVP": 0, "TAM": 3, "TRA": 4, "TUR": 0,
+    "UNI": 1, "UNJ": 2, "WAI": 1, "WAS": 0, "XX1": 1, "YNJ": 1, "ZAM": 0,
+}
+PROFILE_PHASE = SimpleNamespace(INPUT = 0, UPDATE = 1, BROADPHASE = 2, NARROWPHASE = 3, LEVEL_DRAW = 4, SPRITE_DRAW = 5, PRESENT = 6)
+PROFILE_PHASES = ("input", "update", "broadphase", "narrowphase", "level draw", "sprite draw", "present")
+PROFILE_COLORS = ((80, 160, 255, 255), (80, 220, 120, 255), (255, 200, 60, 255), (255, 120, 40, 255), (200, 80, 255, 255), (255, 80, 160, 255), (160, 160, 160, 255))
+
+TSC_TEXT = 0
+TSC_NAMES = [None] + sorted(TSC_ARGUMENT_COUNTS)
+TSC_OPCODES = {name: opcode for opcode, name in enumerate(TSC_NAMES) if name is not None}
+
+NPC_FLAG = SimpleNamespace(SOLID_SOFT = 0x0001, IGNORE_TILE_44 = 0x0002, INVULNERABLE = 0x0004, IGNORE_SOLIDITY = 0x0008, BOUNCY = 0x0010, SHOOTABLE = 0x0020, SOLID_HARD = 0x0040, REAR_AND_TOP_DONT_HURT = 0x0080,
+                           EVENT_WHEN_TOUCHED = 0x0100, EVENT_WHEN_KILLED = 0x0200, APPEAR_WHEN_FLAG_SET = 0x0800, SPAWN_IN_OTHER_DIRECTION = 0x1000, INTERACTABLE = 0x2000, HIDE_WHEN_FLAG_SET = 0x4000, SHOW_DAMAGE = 0x8000)
+
+STAGE_ENTITY = [("x", "<u2"), ("y", "<u2"), ("flag", "<u2"), ("event", "<u2"), ("type", "<u2"), ("bits", "<u2")] #NumPy dtype of a PXE entity record
+
+BACKGROUND_MODE = SimpleNamespace(FIXED = 0, PARALLAX = 1, FOLLOW = 2, WATER = 3, BLACK = 4, AUTO_SCROLL = 5, LAYERED = 6, LAYERED_FAST = 7) #numbering of the original stage table
+
+#sourceY, height (0 for the rest of the sheet), camera factor x, camera factor y, auto-scroll factor, repeat vertically
+BACKGROUND_LAYERS = {
+    BACKGROUND_MODE.FIXED: ((0, 0, 0.0, 0.0, 0, True),),
+    BACKGROUND_MODE.PARALLAX: ((0, 0, 0.5, 0.5, 0, True),),
+    BACKGROUND_MODE.FOLLOW: ((0, 0, 1.0, 1.0, 0, True),),
+    BACKGROUND_MODE.WATER: ((0, 0, 1.0, 1.0, 0, True),),
+    BACKGROUND_MODE.AUTO_SCROLL: ((0, 0, 0.0, 1.0, 6, True),),
+    BACKGROUND_MODE.LAYERED: ((0, 88, 0.0, 0.0, 0, False), (88, 35, 0.0, 0.0, 0.5, False), (123, 23, 0.0, 0.0, 1, False), (146, 30, 0.0, 0.0, 2, False), (176, 64, 0.0, 0.0, 4, False)),
+    BACKGROUND_MODE.LAYERED_FAST: ((0, 88, 0.0, 0.0, 0, False), (88, 35, 0.0, 0.0, 1, False), (123, 23, 0.0, 0.0, 2, False), (146, 30, 0.0, 0.0, 4, False), (176, 64, 0.0, 0.0, 8, False)),
+}
+
+#The original stage table, indexed by stage number: map, tileset (Prt*.pbm and *.pxa), backdrop, background mode
+STAGE_TABLE = [
+    ("0", "0", "bk0", 4), ("Pens1", "Pens", "bkBlue", 1), ("Eggs", "Eggs", "bkGreen", 1), ("EggX", "EggX", "bk0", 4),
+    ("Egg6", "EggIn", "bk0", 4), ("EggR", "Store", "bk0", 4), ("Weed", "Weed", "bkBlue", 1), ("Santa", "Barr", "bk0", 4),
+    ("Chako", "Barr", "bkBlue", 1), ("MazeI", "Maze", "bk0", 4), ("Sand", "Sand", "bkGreen", 1), ("Mimi", "Mimi", "bkBlue", 1),
+    ("Cave", "Cave", "bk0", 4), ("Start", "Cave", "bk0", 4), ("Barr", "Mimi", "bk0", 4), ("Pool", "Mimi", "bkBlue", 1),
+    ("Cemet", "Mimi", "bk0", 4), ("Plant", "Mimi", "bkGreen", 1), ("Shelt", "Store", "bk0", 4), ("Comu", "Pens", "bkBlue", 1),
+    ("MiBox", "Mimi", "bk0", 4), ("EgEnd1", "Store", "bk0", 4), ("Cthu", "Store", "bk0", 4), ("Egg1", "EggIn", "bk0", 4),
+    ("Pens2", "Pens", "bkBlue", 1), ("Malco", "Barr", "bkBlue", 1), ("WeedS", "Barr", "bkBlue", 1), ("WeedD", "Store", "bkBlue", 1),
+    ("Frog", "Weed", "bkGreen", 2), ("Curly", "Sand", "bk0", 4), ("WeedB", "Pens", "bkBlue", 1), ("Stream", "River", "bkBlue", 5),
+    ("CurlyS", "Pens", "bk0", 4), ("Jenka1", "Barr", "bk0", 4), ("Dark", "Sand", "bkBlack", 1), ("Gard", "Gard", "bkGard", 1),
+    ("Jenka2", "Barr", "bk0", 4), ("SandE", "Sand", "bkGreen", 1), ("MazeH", "Maze", "bk0", 4), ("MazeW", "Maze", "bkMaze", 1),
+    ("MazeO", "Maze", "bk0", 4), ("MazeD", "Maze", "bk0", 4), ("MazeA", "Store", "bk0", 4), ("MazeB", "Maze", "bkBlue", 1),
+    ("MazeS", "Maze", "bkGray", 2), ("MazeM", "Maze", "bkRed", 1), ("Drain", "Cave", "bkWater", 3), ("Almond", "Almond", "bkWater", 3),
+    ("River", "River", "bkGreen", 2), ("Eggs2", "Eggs", "bkGreen", 1), ("Cthu2", "Store", "bk0", 4), ("EggR2", "Store", "bk0", 4),
+    ("EggX2", "EggX", "bk0", 4), ("Oside", "Oside", "bkMoon", 6), ("EgEnd2", "Store", "bk0", 4), ("Itoh", "Store", "bkBlue", 2),
+    ("Cent", "Cent", "bkGreen", 1), ("Jail1", "Jail", "bk0", 4), ("Momo", "Jail", "bk0", 4), ("Lounge", "Jail", "bk0", 4),
+    ("CentW", "Store", "bk0", 4), ("Jail2", "Store", "bk0", 4), ("Blcny1", "White", "bkFog", 7), ("Priso1", "Jail", "bkGray", 4),
+    ("Ring1", "White", "bk0", 4), ("Ring2", "White", "bk0", 4), ("Prefa1", "Pens", "bk0", 4), ("Priso2", "Jail", "bkGray", 4),
+    ("Ring3", "White", "bk0", 4), ("Little", "Pens", "bkBlue", 2), ("Blcny2", "White", "bkFog", 7), ("Fall", "Fall", "bkFall", 1),
+    ("Kings", "White", "bk0", 4), ("Pixel", "Pens", "bkBlue", 1), ("e_Maze", "Maze", "bkMaze", 1), ("e_Jenk", "Barr", "bk0", 4),
+    ("e_Malc", "Barr", "bkBlue", 1), ("e_Ceme", "Mimi", "bk0", 4), ("e_Sky", "Fall", "bkFall", 1), ("Prefa2", "Pens", "bk0", 4),
+    ("Hell1", "Hell", "bkRed", 2), ("Hell2", "Hell", "bkRed", 2), ("Hell3", "Hell", "bkRed", 1), ("Mapi", "Cave", "bk0", 2),
+    ("Hell4", "Hell", "bk0", 4), ("Hell42", "Hell", "bk0", 4), ("Statue", "Hell", "bkBlue", 1), ("Ballo1", "Hell", "bkBlue", 2),
+    ("Ostep", "White", "bkFog", 7), ("e_Labo", "Labo", "bk0", 4), ("Pole", "Cave", "bk0", 4), ("Island", "0", "bk0", 4),
+    ("Ballo2", "Hell", "bkBlue", 2), ("e_Blcn", "White", "bkFog", 7), ("Clock", "Oside", "bkMoon", 6),
+]
+STAGE_NUMBERS = {entry[0]: number for number, entry in enumerate(STAGE_TABLE)}
+
 class Direction(Enum):
     LEFT = 0
     RIGHT = 1
@@ -47,51 +181,66 @@ class Direction(Enum):
     DOWN = 3
 
 class Vector2(object):
+    __slots__ = ("x", "y")
+
     def __init__(self, x = 0, y = 0):
         self.x = x
         self.y = y
 
+    def set(self, x, y):
+        self.x = x
+        self.y = y
+
     def zero(self):
         return Vector2(0, 0)
 
 class Tileset(object):
-    def __init__(self, texture = None, firstGid = -1):
+    def __init__(self, texture = None, firstGid = -1, path = None):
         self.FirstGid = firstGid
         self.Texture = texture
+        self.Path = path
 
         
 class Sprite(object):
+    __slots__ = ("_x", "_y", "_sourceRect", "_spriteSheet", "_boundingBox", "_filePath", "_originX", "_originY")
+
     def __init__(self, graphics, filePath, sourceX, sourceY, width, height, posX, posY):
         self._x = posX
         self._y = posY
         self._sourceRect = SDL_Rect()
-        self._spriteSheet = POINTER(SDL_Texture)()
-        self._sourceRect.x = sourceX
-        self._sourceRect.y = sourceY
-        self._sourceRect.w = width
-        self._sourceRect.h = height
         self._boundingBox = Rectangle(self._x, self._y, width * GLOBAL.SPRITE_SCALE, height * GLOBAL.SPRITE_SCALE)
 
-        self._spriteSheet = SDL_CreateTextureFromSurface(graphics._renderer, graphics.loadImage(filePath))
+        #The sheet may live on a shared atlas page, so source rects are offset by its origin there
+        self._filePath = filePath
+        self._spriteSheet, self._originX, self._originY = graphics.acquireSheet(filePath)
         if (self._spriteSheet == None):
             print("\nError: Unable to load image\n")
+        self._sourceRect.x = sourceX + self._originX
+        self._sourceRect.y = sourceY + self._originY
+        self._sourceRect.w = width
+        self._sourceRect.h = height
         
 
-    #def __del__(self):
-
+    def unload(self, graphics):
+        if self._spriteSheet is not None:
+            graphics.releaseSheet(self._filePath)
+            self._spriteSheet = None
 
     def update(self):
-        self._boundingBox = Rectangle(self._x, self._y, self._sourceRect.w * GLOBAL.SPRITE_SCALE, self._sourceRect.h * GLOBAL.SPRITE_SCALE)
+        self._boundingBox.set(self._x, self._y, self._sourceRect.w * GLOBAL.SPRITE_SCALE, self._sourceRect.h * GLOBAL.SPRITE_SCALE)
 
     def draw(self, graphics, x, y):
-        destinationRectangle = SDL_Rect(x, y, self._sourceRect.w * GLOBAL.SPRITE_SCALE, self._sourceRect.h * GLOBAL.SPRITE_SCALE)
-        graphics.blitSurface(self._spriteSheet, byref(self._sourceRect), byref(destinationRectangle))
+        source = self._sourceRect
+        graphics.drawQuad(self._spriteSheet, source.x, source.y, source.w, source.h, int(x), int(y), source.w * GLOBAL.SPRITE_SCALE, source.h * GLOBAL.SPRITE_SCALE)
 
     def getCollisionSide(self, other):
-        amtRight = self._boundingBox.getRight() - other.getLeft()
-        amtLeft = other.getRight() - self._boundingBox.getLeft()
-        amtTop = other.getBottom() - self._boundingBox.getTop()
-        amtBottom = self._boundingBox.getBottom() - other.getTop()
+        return self.getCollisionSideBounds(other.getLeft(), other.getTop(), other.getRight(), other.getBottom())
+
+    def getCollisionSideBounds(self, left, top, right, bottom):
+        amtRight = self._boundingBox.getRight() - left
+        amtLeft = right - self._boundingBox.getLeft()
+        amtTop = bottom - self._boundingBox.getTop()
+        amtBottom = self._boundingBox.getBottom() - top
 
         lowest = min(abs(amtRight), abs(amtLeft), abs(amtTop), abs(amtBottom))
 
@@ -107,33 +256,74 @@ class Sprite(object):
             return Side.NONE
 
 
+class AnimationTable(object):
+    __slots__ = ("_ids", "_rects", "_starts", "_counts", "_offsets")
+
+    def __init__(self):
+        self._ids = {}
+        self._rects = array.array("i")      #x, y, w, h per frame, contiguous across animations
+        self._starts = array.array("i")     #first frame of each animation
+        self._counts = array.array("i")
+        self._offsets = array.array("i")    #x, y per animation
+
+    def addAnimation(self, name, frames, x, y, width, height, offset):
+        animation = len(self._starts)
+        self._ids[name] = animation
+        self._starts.append(len(self._rects) // 4)
+        self._counts.append(frames)
+        self._offsets.extend((offset.x, offset.y))
+        for i in range(0, frames):
+            self._rects.extend(((i + x) * width, y, width, height))
+        return animation
+
+    def getId(self, name):
+        return self._ids[name]
+
+_animationTables = {}
+
+def getAnimationTable(key, build):
+    table = _animationTables.get(key)
+    if table is None:
+        table = _animationTables.setdefault(key, build())
+    return table
+
+
 class AnimatedSprite(Sprite):
+    __slots__ = ("_frameIndex", "_ticksPerFrame", "_ticks", "_visible", "_currentAnimationOnce", "_currentAnimation", "_frameStart", "_frameCount", "_animationTable")
+
     def __init__(self, graphics, filePath, sourceX, sourceY, width, height, posX, posY, timeToUpdate):
         super().__init__(graphics, filePath, sourceX, sourceY, width, height, posX, posY)
         self._frameIndex = 0
-        self._timeToUpdate = timeToUpdate
-        self._timeElapsed = 0
+        self._ticksPerFrame = int(timeToUpdate)
+        self._ticks = 0
         self._visible = True
         self._currentAnimationOnce = False
-        self._currentAnimation = ""
-        self._animations = {}
-        self._offsets = {}
+        self._currentAnimation = -1
+        self._frameStart = 0
+        self._frameCount = 0
+        #Most sprites are handed a shared table by setAnimationTable, so only build one for sprites that add their own
+        self._animationTable = None
 
 
 
     def playAnimation(self, animation, once = False):
         self._currentAnimationOnce = once
+        if (animation.__class__ is str):
+            animation = self._animationTable.getId(animation)
         if (self._currentAnimation != animation):
             self._currentAnimation = animation
+            self._frameStart = self._animationTable._starts[animation]
+            self._frameCount = self._animationTable._counts[animation]
             self._frameIndex = 0
 
     def update(self, elapsedTime):
         super().update()
 
-        self._timeElapsed += elapsedTime
-        if (self._timeElapsed > self._timeToUpdate):
-            self._timeElapsed -= self._timeToUpdate
-            if (self._frameIndex < len(self._animations[self._currentAnimation]) - 1):
+        #Whole milliseconds, so frame timing does not drift with float accumulation
+        self._ticks += int(elapsedTime)
+        if (self._ticks > self._ticksPerFrame):
+            self._ticks -= self._ticksPerFrame
+            if (self._frameIndex < self._frameCount - 1):
                 self._frameIndex += 1
             else:
                 if (self._currentAnimationOnce == True):
@@ -143,28 +333,25 @@ class AnimatedSprite(Sprite):
 
     def draw(self, graphics, x, y):
         if (self._visible):
-            destinationRectangle = SDL_Rect()
-            destinationRectangle.x = int(x) + self._offsets[self._currentAnimation].x
-            destinationRectangle.y = int(y) + self._offsets[self._currentAnimation].y
-            destinationRectangle.w = self._sourceRect.w * GLOBAL.SPRITE_SCALE
-            destinationRectangle.h = self._sourceRect.h * GLOBAL.SPRITE_SCALE
+            table = self._animationTable
+            rects = table._rects
+            frame = (self._frameStart + self._frameIndex) * 4
+            offset = self._currentAnimation * 2
+            graphics.drawQuad(self._spriteSheet, rects[frame] + self._originX, rects[frame + 1] + self._originY, rects[frame + 2], rects[frame + 3],
+                int(x) + table._offsets[offset], int(y) + table._offsets[offset + 1], self._sourceRect.w * GLOBAL.SPRITE_SCALE, self._sourceRect.h * GLOBAL.SPRITE_SCALE)
 
-            sourceRect = self._animations[self._currentAnimation][self._frameIndex]
-            graphics.blitSurface(self._spriteSheet, sourceRect, destinationRectangle)
 
+    def setAnimationTable(self, table):
+        self._animationTable = table
+        self._currentAnimation = -1
 
     def addAnimations(self, frames, x, y, name, width, height, offset):
-        rectangles = []
-        for i in range(0, frames):
-            newRect = SDL_Rect((i + x) * width, y, width, height)
-            rectangles.append(newRect)
-
-        self._animations[name] = rectangles
-        self._offsets[name] = offset
+        if self._animationTable is None:
+            self._animationTable = AnimationTable()
+        return self._animationTable.addAnimation(name, frames, x, y, width, height, offset)
 
     def resetAnimations(self):
-        self._animations.clear()
-        self._offsets.clear()
+        self.setAnimationTable(AnimationTable())
 
     def stopAnimation(self):
         self._frameIndex = 0
@@ -178,23 +365,53 @@ class AnimatedSprite(Sprite):
 
 
 class Player(AnimatedSprite):
+    __slots__ = ("_dx", "_dy", "_facing", "_grounded", "_previousX", "_previousY", "_fireCooldown")
+
     def __init__(self, graphics, spawnPoint):
         cPath = PATHNAME + "/../Resources/sprites/MyChar.png"
         super().__init__(graphics, cPath, 0, 0, 16, 16, spawnPoint.x, spawnPoint.y, 100)
-        graphics.loadImage(cPath)
         
         self.setupAnimations()
-        self.playAnimation("RunRight")
+        self.playAnimation(PLAYER_ANIMATION.RUN_RIGHT)
         self._dx = 0
         self._dy = 0
         self._facing = Direction.RIGHT
         self._grounded = False
-
-    def draw(self, graphics):
-        super().draw(graphics, self._x, self._y)
+        self._previousX = self._x
+        self._previousY = self._y
+        self._fireCooldown = 0
+
+    def draw(self, graphics, camera, alpha = 1.0):
+        if camera.collidesWith(self._boundingBox):
+            x, y = self.interpolate(alpha)
+            super().draw(graphics, x - camera.getLeft(), y - camera.getTop())
+
+    def getState(self):
+        return (self._x, self._y, self._dx, self._dy, self._previousX, self._previousY, self._fireCooldown,
+                self._currentAnimation, self._frameIndex, self._ticks, self._grounded, self._facing.value, self._currentAnimationOnce, self._visible)
+
+    def setState(self, state):
+        self._x, self._y, self._dx, self._dy, self._previousX, self._previousY, self._fireCooldown, animation, frameIndex, ticks, grounded, facing, once, visible = state
+        self._grounded = grounded != 0
+        self._facing = Direction(facing)
+        self._currentAnimation = -1
+        self.playAnimation(animation, once != 0)
+        self._frameIndex = frameIndex
+        self._ticks = ticks
+        self._visible = visible != 0
+        Sprite.update(self)
+
+    def interpolate(self, alpha):
+        if alpha >= 1.0:
+            return self._x, self._y
+        return self._previousX + (self._x - self._previousX) * alpha, self._previousY + (self._y - self._previousY) * alpha
 
 
     def update(self, elapsedTime):
+        self._previousX = self._x
+        self._previousY = self._y
+        if self._fireCooldown > 0:
+            self._fireCooldown -= elapsedTime
         if self._dy <= PLAYER_CONSTANTS.GRAVITY_CAP:
             self._dy += PLAYER_CONSTANTS.GRAVITY * elapsedTime
         self._x += self._dx * elapsedTime
@@ -207,24 +424,39 @@ class Player(AnimatedSprite):
 
 
     def setupAnimations(self):
-        self.addAnimations(1, 0, 0, "IdleLeft", 16, 16, Vector2(0, 0))
-        self.addAnimations(1, 0, 16, "IdleRight", 16, 16, Vector2(0, 0))
-        self.addAnimations(3, 0, 0, "RunLeft", 16, 16, Vector2(0, 0))
-        self.addAnimations(3, 0, 16, "RunRight", 16, 16, Vector2(0, 0))
+        self.setAnimationTable(getAnimationTable("MyChar", buildPlayerAnimations))
 
     def moveLeft(self):
         self._dx = -PLAYER_CONSTANTS.WALK_SPEED
-        self.playAnimation("RunLeft")
+        self.playAnimation(PLAYER_ANIMATION.RUN_LEFT)
         self._facing = Direction.LEFT
 
     def moveRight(self):
         self._dx = PLAYER_CONSTANTS.WALK_SPEED
-        self.playAnimation("RunRight")
+        self.playAnimation(PLAYER_ANIMATION.RUN_RIGHT)
         self._facing = Direction.RIGHT
 
     def stopMoving(self):
         self._dx = 0
-        self.playAnimation("IdleRight" if self._facing == Direction.RIGHT else "IdleLeft")
+        self.playAnimation(PLAYER_ANIMATION.IDLE_RIGHT if self._facing == Direction.RIGHT else PLAYER_ANIMATION.IDLE_LEFT)
+
+    def shoot(self, projectiles, carets, aim):
+        if self._fireCooldown > 0:
+            return
+        self._fireCooldown = PROJECTILE.FIRE_INTERVAL
+
+        box = self._boundingBox
+        x, y = box.getCenterX(), box.getCenterY()
+        if aim == Direction.UP:
+            animation, dx, dy, y = BULLET_ANIMATION.MACHINE_GUN_UP, 0, -PROJECTILE.SPEED, box.getTop()
+        elif aim == Direction.DOWN:
+            animation, dx, dy, y = BULLET_ANIMATION.MACHINE_GUN_DOWN, 0, PROJECTILE.SPEED, box.getBottom()
+        elif aim == Direction.LEFT:
+            animation, dx, dy, x = BULLET_ANIMATION.MACHINE_GUN_LEFT, -PROJECTILE.SPEED, 0, box.getLeft()
+        else:
+            animation, dx, dy, x = BULLET_ANIMATION.MACHINE_GUN_RIGHT, PROJECTILE.SPEED, 0, box.getRight()
+        if projectiles.spawn(animation, x, y, dx, dy, PROJECTILE.LIFETIME) != -1:
+            carets.spawn(CARET_ANIMATION.SHOOT, x, y)
 
     def jump(self):
         if self._grounded:
@@ -234,22 +466,49 @@ class Player(AnimatedSprite):
 
     def handleTileCollisions(self, others):
         for i in range(0, len(others)):
-            collisionSide = Sprite.getCollisionSide(self, others[i])
-            if collisionSide != Side.NONE:
-                if collisionSide == Side.TOP:
-                    self._y = others[i].getBottom() + 1
-                    self._dy = 0
+            self.resolveTileCollision(others[i].getLeft(), others[i].getTop(), others[i].getRight(), others[i].getBottom())
+
+    def handleTileGridCollisions(self, tiles, tileSize):
+        for tx, ty in tiles:
+            left = tx * tileSize
+            top = ty * tileSize
+            self.resolveTileCollision(left, top, left + tileSize, top + tileSize)
+
+    def resolveTileCollision(self, left, top, right, bottom):
+        collisionSide = Sprite.getCollisionSideBounds(self, left, top, right, bottom)
+        if collisionSide != Side.NONE:
+            if collisionSide == Side.TOP:
+                self._y = bottom + 1
+                self._dy = 0
+
+            elif collisionSide == Side.BOTTOM:
+                self._y = top - self._boundingBox._height - 1
+                self._dy = 0
+                self._grounded = True
 
-                elif collisionSide == Side.BOTTOM:
-                    self._y = others[i].getTop() - self._boundingBox._height - 1
-                    self._dy = 0
-                    self._grounded = True
+            elif collisionSide == Side.LEFT:
+                self._x = right + 1
 
-                elif collisionSide == Side.LEFT:
-                    self._x = others[i].getRight() + 1
+            elif collisionSide == Side.RIGHT:
+                self._x = left - self._boundingBox._width - 1
 
-                elif collisionSide == Side.RIGHT:
-                    self._x = others[i].getLeft() - self._boundingBox._width - 1
+    def handleTileGridSlopes(self, slopes, tileSize):
+        centerX = int(self._boundingBox.getCenterX())
+        for tx, ty, leftY, rightY, floor in slopes:
+            left = tx * tileSize
+            if centerX < left or centerX >= left + tileSize:
+                continue
+
+            surfaceY = ty * tileSize + leftY + (rightY - leftY) * (centerX - left) // tileSize
+            if floor:
+                if self._y + self._boundingBox._height >= surfaceY:
+                    self._y = surfaceY - self._boundingBox._height
+                    self._dy = 0
+                    self._grounded = True
+            elif self._y <= surfaceY:
+                self._y = surfaceY + 1
+                if self._dy < 0:
+                    self._dy = 0
 
     def handleSlopeCollisions(self, others):
         for i in range(0, len(others)):
@@ -261,13 +520,181 @@ class Player(AnimatedSprite):
                 self._y = newY - self._boundingBox._height
                 self._grounded = True
 
+
+def buildPlayerAnimations():
+    table = AnimationTable()
+    table.addAnimation("IdleLeft", 1, 0, 0, 16, 16, Vector2(0, 0))
+    table.addAnimation("IdleRight", 1, 0, 16, 16, 16, Vector2(0, 0))
+    table.addAnimation("RunLeft", 3, 0, 0, 16, 16, Vector2(0, 0))
+    table.addAnimation("RunRight", 3, 0, 16, 16, 16, Vector2(0, 0))
+    return table
+
+
+def buildBulletAnimations():
+    table = AnimationTable()
+    table.addAnimation("MachineGunLeft", 1, 4, 0, 16, 16, Vector2(0, 0))
+    table.addAnimation("MachineGunUp", 1, 5, 0, 16, 16, Vector2(0, 0))
+    table.addAnimation("MachineGunRight", 1, 6, 0, 16, 16, Vector2(0, 0))
+    table.addAnimation("MachineGunDown", 1, 7, 0, 16, 16, Vector2(0, 0))
+    return table
+
+def buildCaretAnimations():
+    table = AnimationTable()
+    table.addAnimation("Shoot", 4, 0, 48, 16, 16, Vector2(0, 0))
+    table.addAnimation("WallHit", 4, 0, 32, 16, 16, Vector2(0, 0))
+    return table
+
+
+class SpritePool(object):
+    COLUMNS = (("_x", "float32"), ("_y", "float32"), ("_dx", "float32"), ("_dy", "float32"), ("_life", "float32"), ("_ticks", "float32"),
+               ("_animation", "int32"), ("_frame", "int32"), ("_alive", "bool"))
+
+    def __init__(self, graphics, filePath, table, capacity, frameTime, loop):
+        self._filePath = filePath
+        self._texture, self._originX, self._originY = graphics.acquireSheet(filePath)
+        self._table = table
+        self._starts = np.frombuffer(table._starts, dtype = np.int32)
+        self._counts = np.frombuffer(table._counts, dtype = np.int32)
+        self._frameTime = frameTime
+        self._loop = loop
+        self._capacity = capacity
+        for name, dtype in SpritePool.COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype = dtype))
+        #Scratch columns for update, so a frame with live slots doesn't allocate temporaries
+        self._step = np.zeros(capacity, dtype = np.float32)
+        self._frameLimit = np.zeros(capacity, dtype = np.int32)
+        self._advance = np.zeros(capacity, dtype = np.bool_)
+        self._finished = np.zeros(capacity, dtype = np.bool_)
+        #Slots are handed out from the end of the list, lowest index first
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def getCount(self):
+        return self._capacity - len(self._free)
+
+    def spawn(self, animation, x, y, dx = 0, dy = 0, life = math.inf):
+        if len(self._free) == 0:
+            return -1
+        index = self._free.pop()
+        self._x[index] = x
+        self._y[index] = y
+        self._dx[index] = dx
+        self._dy[index] = dy
+        self._life[index] = life
+        self._ticks[index] = 0
+        self._animation[index] = animation
+        self._frame[index] = 0
+        self._alive[index] = True
+        return index
+
+    def despawn(self, index):
+        if self._alive[index]:
+            self._alive[index] = False
+            self._free.append(index)
+
+    def rebuildFreeList(self):
+        self._free = np.flatnonzero(~self._alive)[::-1].tolist()
+
+    def despawnAll(self, mask):
+        if not mask.any():
+            return
+        indices = np.flatnonzero(mask)
+        self._alive[indices] = False
+        self._free.extend(indices.tolist())
+
+    def clear(self):
+        self._alive[:] = False
+        self._free = list(range(self._capacity - 1, -1, -1))
+
+    def update(self, elapsedTime):
+        if self.getCount() == 0:
+            return
+
+        alive = self._alive
+        step = self._step
+        np.multiply(self._dx, elapsedTime, out = step)
+        self._x += step
+        np.multiply(self._dy, elapsedTime, out = step)
+        self._y += step
+        self._life -= elapsedTime
+        self._ticks += elapsedTime
+
+        advance = np.greater_equal(self._ticks, self._frameTime, out = self._advance)
+        advance &= alive
+        self._frame += advance
+        np.subtract(self._ticks, self._frameTime, out = self._ticks, where = advance)
+        np.take(self._counts, self._animation, out = self._frameLimit)
+        finished = np.greater_equal(self._frame, self._frameLimit, out = self._finished)
+        finished &= advance
+        expired = np.less_equal(self._life, 0, out = self._advance)
+        expired &= alive
+        if self._loop:
+            np.copyto(self._frame, 0, where = finished)
+            self.despawnAll(expired)
+        else:
+            finished |= expired
+            self.despawnAll(finished)
+
+    def draw(self, graphics, camera):
+        rects = self._table._rects
+        offsets = self._table._offsets
+        left, top, right, bottom = camera.getLeft(), camera.getTop(), camera.getRight(), camera.getBottom()
+        for index in np.flatnonzero(self._alive).tolist():
+            animation = int(self._animation[index])
+            frame = (int(self._starts[animation]) + int(self._frame[index])) * 4
+            width = rects[frame + 2] * GLOBAL.SPRITE_SCALE
+            height = rects[frame + 3] * GLOBAL.SPRITE_SCALE
+            #Pooled sprites are positioned by their centre
+            x = int(self._x[index]) - width // 2 + offsets[animation * 2]
+            y = int(self._y[index]) - height // 2 + offsets[animation * 2 + 1]
+            if x + width >= left and x <= right and y + height >= top and y <= bottom:
+                graphics.drawQuad(self._texture, rects[frame] + self._originX, rects[frame + 1] + self._originY, rects[frame + 2], rects[frame + 3], x - left, y - top, width, height)
+
+    def unload(self, graphics):
+        if self._texture is not None:
+            graphics.releaseSheet(self._filePath)
+            self._texture = None
+
+
+class ProjectilePool(SpritePool):
+    def __init__(self, graphics, capacity = PROJECTILE.CAPACITY):
+        super().__init__(graphics, PROJECTILE.BULLET_PATH, getAnimationTable("Bullet", buildBulletAnimations), capacity, PROJECTILE.FRAME_TIME, True)
+        #Scratch for the wall test; _step is free again once SpritePool.update has moved everything
+        self._cells = np.zeros(capacity, dtype = np.intp)
+        self._hits = np.zeros(capacity, dtype = np.bool_)
+
+    def update(self, elapsedTime, level = None, carets = None):
+        super().update(elapsedTime)
+        if level is None or self.getCount() == 0:
+            return
+
+        hits = level.pointsInSolid(self._x, self._y, self._hits, self._cells, self._step)
+        hits &= self._alive
+        if carets is not None and hits.any():
+            for index in np.flatnonzero(hits).tolist():
+                carets.spawn(CARET_ANIMATION.WALL_HIT, self._x[index], self._y[index])
+        self.despawnAll(hits)
+
+
+class CaretPool(SpritePool):
+    def __init__(self, graphics, capacity = PROJECTILE.CARET_CAPACITY):
+        super().__init__(graphics, PROJECTILE.CARET_PATH, getAnimationTable("Caret", buildCaretAnimations), capacity, PROJECTILE.CARET_FRAME_TIME, False)
+
+
 class Rectangle(object):
+    __slots__ = ("_x", "_y", "_width", "_height")
+
     def __init__(self, x, y, width, height):
         self._x = x
         self._y = y
         self._width = width
         self._height = height
 
+    def set(self, x, y, width, height):
+        self._x = x
+        self._y = y
+        self._width = width
+        self._height = height
+
     def getCenterX(self):
         return self._x + self._width // 2
     
@@ -305,6 +732,8 @@ class Rectangle(object):
         return self._x >= 0 and self._y >= 0 and self._width >= 0 and self._height >= 0
 
 class Slope(object):
+    __slots__ = ("_p1", "_p2", "_slope")
+
     def __init__(self, p1, p2):
         self._p1 = p1
         self._p2 = p2
@@ -315,234 +744,1797 @@ class Slope(object):
         return ((other.getRight() >= self._p2.x and other.getLeft() <= self._p1.x and other.getTop() <= self._p2.y and other.getBottom() >= self._p1.y) or (other.getRight() >= self._p1.x and other.getLeft() <= self._p2.x and other.getTop() <= self._p1.y and other.getBottom() >= self._p2.y) or \
             (other.getLeft() <= self._p1.x and other.getRight() >= self._p2.x and other.getTop() <= self._p1.y and other.getBottom() >= self._p2.y) or (other.getLeft() <= self._p2.x and other.getRight() >= self._p1.x and other.getTop() <= self._p2.y and other.getBottom() >= self._p1.y))
 
+class Camera(Rectangle):
+    __slots__ = ()
+
+    def __init__(self, width = GLOBAL.SCREEN_WIDTH, height = GLOBAL.SCREEN_HEIGHT):
+        super().__init__(0, 0, width, height)
+
+    def follow(self, target, levelWidth, levelHeight):
+        self.centerOn(target.getCenterX(), target.getCenterY(), levelWidth, levelHeight)
+
+    def centerOn(self, centerX, centerY, levelWidth, levelHeight):
+        x = centerX - self._width // 2
+        y = centerY - self._height // 2
+        self._x = int(max(0, min(x, levelWidth - self._width)))
+        self._y = int(max(0, min(y, levelHeight - self._height)))
+
+    def getVisibleRange(self, start, end, cellSize, count):
+        return max(0, start // cellSize), min(count, -(-end // cellSize))
+
+
+class SpatialGrid(object):
+    def __init__(self, cellSize):
+        self._cellSize = cellSize
+        self._cells = {}
+
+    def insert(self, index, left, top, right, bottom):
+        cellSize = self._cellSize
+        for cy in range(int(top // cellSize), int(bottom // cellSize) + 1):
+            for cx in range(int(left // cellSize), int(right // cellSize) + 1):
+                self._cells.setdefault((cx, cy), []).append(index)
+
+    def query(self, left, top, right, bottom):
+        cellSize = self._cellSize
+        cells = self._cells
+        found = set()
+        for cy in range(int(top // cellSize), int(bottom // cellSize) + 1):
+            for cx in range(int(left // cellSize), int(right // cellSize) + 1):
+                indices = cells.get((cx, cy))
+                if indices is not None:
+                    found.update(indices)
+        return sorted(found)
+
+#The software renderer rasterises geometry itself, which is slower than SDL_RenderCopy and samples texels differently
+def supportsRenderGeometry(renderer):
+    if not hasattr(sdl2, "SDL_RenderGeometry"):
+        return False
+    version = SDL_version()
+    SDL_GetVersion(byref(version))
+    if (version.major, version.minor, version.patch) < (2, 0, 18):
+        return False
+    info = SDL_RendererInfo()
+    if SDL_GetRendererInfo(renderer, byref(info)) != 0:
+        return False
+    return (info.flags & SDL_RENDERER_ACCELERATED) != 0
+
+
+#A batch only merges consecutive quads from one texture: unbaked tiles, pooled bullets and carets, and sprites sharing an atlas sheet.
+#Each baked chunk is a texture of its own, so with chunks baked most flushes draw a single quad
+class RenderBatch(object):
+    def __init__(self, capacity = RENDER.BATCH_CAPACITY):
+        self._capacity = capacity
+        self._vertices = (SDL_Vertex * (capacity * 4))()
+        self._indices = (c_int * (capacity * 6))()
+        np.frombuffer(self._indices, dtype = np.int32)[:] = (np.arange(capacity, dtype = np.int32)[:, None] * 4 + [0, 1, 2, 2, 1, 3]).ravel()
+        self._vertexArray = np.frombuffer(self._vertices, dtype = np.float32).reshape(capacity, 4, 5)
+        np.frombuffer(self._vertices, dtype = np.uint32).reshape(capacity, 4, 5)[:, :, 2] = 0xFFFFFFFF
+        self._texture = None
+        self._textureWidth = 1
+        self._textureHeight = 1
+        self._count = 0
+
+    def add(self, renderer, texture, sourceX, sourceY, sourceWidth, sourceHeight, x, y, width, height):
+        if texture is not self._texture:
+            self.flush(renderer)
+            self._texture = texture
+            textureWidth, textureHeight = c_int(0), c_int(0)
+            SDL_QueryTexture(texture, None, None, byref(textureWidth), byref(textureHeight))
+            self._textureWidth = textureWidth.value
+            self._textureHeight = textureHeight.value
+
+        #Vertices go straight into the buffer SDL_RenderGeometry reads, in the order the index buffer expects
+        u0 = sourceX / self._textureWidth
+        v0 = sourceY / self._textureHeight
+        u1 = (sourceX + sourceWidth) / self._textureWidth
+        v1 = (sourceY + sourceHeight) / self._textureHeight
+        quad = self._vertexArray[self._count]
+        quad[:, 0] = (x, x + width, x, x + width)
+        quad[:, 1] = (y, y, y + height, y + height)
+        quad[:, 3] = (u0, u1, u0, u1)
+        quad[:, 4] = (v0, v0, v1, v1)
+        self._count += 1
+        if self._count == self._capacity:
+            self.flush(renderer)
+
+    def flush(self, renderer):
+        count = self._count
+        if count == 0:
+            return
+        self._count = 0
+        SDL_RenderGeometry(renderer, self._texture, self._vertices, count * 4, self._indices, count * 6)
+
+
+class AssetPack(object):
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        self._verified = set()
+        self._lock = threading.Lock()
+        with open(path, "rb") as f:
+            #Copy-on-write so ctypes can point SDL_RWops straight at the mapped pages
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+        self._view = memoryview(self._map)
+
+        magic, version, count, manifestSize, manifestCrc = PACK.HEADER.unpack_from(self._view, 0)
+        if magic != PACK.MAGIC:
+            raise ValueError("Not an asset pack: " + path)
+        if version != PACK.VERSION:
+            raise ValueError("Asset pack version %d, expected %d: %s" % (version, PACK.VERSION, path))
+        manifest = self._view[PACK.HEADER.size:PACK.HEADER.size + manifestSize]
+        if zlib.crc32(manifest) != manifestCrc:
+            raise ValueError("Asset pack manifest is corrupt: " + path)
+
+        offset = 0
+        for i in range(0, count):
+            dataOffset, size, crc = PACK.ENTRY.unpack_from(manifest, offset)
+            name, offset = _unpackString(manifest, offset + PACK.ENTRY.size)
+            if dataOffset + size > len(self._view):
+                raise ValueError("Asset pack is truncated: " + path)
+            self._entries[name] = (dataOffset, size, crc)
+
+    def getNames(self):
+        return list(self._entries)
+
+    def contains(self, name):
+        return name in self._entries
+
+    def getVersion(self, name):
+        return self._entries[name][2]
+
+    def read(self, name):
+        dataOffset, size, crc = self._entries[name]
+        data = self._view[dataOffset:dataOffset + size]
+        if name not in self._verified:
+            if zlib.crc32(data) != crc:
+                raise ValueError("Asset pack entry is corrupt: " + name)
+            with self._lock:
+                self._verified.add(name)
+        return data
+
+    def verify(self):
+        corrupt = []
+        for name, (dataOffset, size, crc) in self._entries.items():
+            if zlib.crc32(self._view[dataOffset:dataOffset + size]) != crc:
+                corrupt.append(name)
+        return corrupt
+
+    def openRW(self, name):
+        data = self.read(name)
+        buffer = (c_char * len(data)).from_buffer(self._map, self._entries[name][0])
+        return SDL_RWFromConstMem(buffer, len(data))
+
+    def close(self):
+        self._entries.clear()
+        self._view.release()
+        self._map.close()
+
+
+_assetPack = None
+_assetPackLock = threading.Lock()
+
+def getAssetPack():
+    global _assetPack
+    with _assetPackLock:
+        if _assetPack is None:
+            _assetPack = False
+            if os.path.exists(PACK.PATH):
+                try:
+                    _assetPack = AssetPack(PACK.PATH)
+                except (OSError, ValueError, struct.error) as e:
+                    print("\nWarning: ignoring asset pack: " + str(e) + "\n")
+        return _assetPack or None
+
+def assetName(path):
+    return os.path.relpath(os.path.abspath(path), PACK.ROOT).replace(os.sep, "/")
+
+def assetExists(path):
+    pack = getAssetPack()
+    return (pack is not None and pack.contains(assetName(path))) or os.path.exists(path)
+
+def assetVersion(path):
+    pack = getAssetPack()
+    if pack is not None and pack.contains(assetName(path)):
+        return pack.getVersion(assetName(path))
+    return os.stat(path).st_mtime_ns
+
+def assetChecksum(path):
+    #The same CRC-32 whether the asset is served from the pack or from a loose file
+    pack = getAssetPack()
+    if pack is not None and pack.contains(assetName(path)):
+        return pack.getVersion(assetName(path))
+    return zlib.crc32(readAsset(path))
+
+def readAsset(path):
+    pack = getAssetPack()
+    if pack is not None and pack.contains(assetName(path)):
+        return pack.read(assetName(path))
+    return _mapFile(path)
+
+
+_sdlImage = None
+
+def getSdlImage():
+    #SDL_image is only loaded once an image is, which keeps it out of import time
+    global _sdlImage
+    if _sdlImage is None:
+        try:
+            import sdl2.sdlimage
+            _sdlImage = sdl2.sdlimage
+        except (ImportError, RuntimeError):
+            _sdlImage = False
+    return _sdlImage or None
+
+def initSubsystems(flags):
+    #Only start what is asked for; SDL_INIT_EVERYTHING would also open audio, joystick and haptic devices
+    missing = flags & ~SDL_WasInit(flags)
+    if missing and SDL_InitSubSystem(missing) != 0:
+        raise RuntimeError("Unable to initialise SDL: " + SDL_GetError().decode("utf-8", "replace"))
+
+def loadPackedImage(pack, name):
+    rw = pack.openRW(name)
+    sdlimage = getSdlImage()
+    if sdlimage is not None:
+        surface = sdlimage.IMG_Load_RW(rw, 1)
+    else:
+        surface = SDL_LoadBMP_RW(rw, 1)
+    if not surface:
+        raise RuntimeError("Unable to decode '%s' from the asset pack: %s" % (name, SDL_GetError().decode("utf-8", "replace")))
+    return surface.contents
+
+def loadImageSurface(filePath):
+    pack = getAssetPack()
+    if pack is not None and pack.contains(assetName(filePath)):
+        surface = loadPackedImage(pack, assetName(filePath))
+    else:
+        sdlimage = getSdlImage()
+        surface = sdlimage.IMG_Load(filePath.encode("utf-8")) if sdlimage is not None else SDL_LoadBMP(filePath.encode("utf-8"))
+        if not surface:
+            raise RuntimeError("Unable to load image '%s': %s" % (filePath, SDL_GetError().decode("utf-8", "replace")))
+        surface = surface.contents
+    if filePath.endswith(".pbm"):
+        SDL_SetColorKey(surface, SDL_TRUE, SDL_MapRGB(surface.format, 0, 0, 0))
+    return surface
+
+class TextureAtlas(object):
+    def __init__(self, path):
+        self._path = path
+        self._sheets = {}   #asset name -> (page, x, y, width, height)
+        self._pages = []    #(offset, size) of each zlib-compressed page
+        self._stale = 0
+        with open(path, "rb") as f:
+            self._data = f.read()
+
+        magic, version, self._pageSize, pageCount, sheetCount = ATLAS.HEADER.unpack_from(self._data, 0)
+        if magic != ATLAS.MAGIC:
+            raise ValueError("Not a texture atlas: " + path)
+        if version != ATLAS.VERSION:
+            raise ValueError("Texture atlas version %d, expected %d: %s" % (version, ATLAS.VERSION, path))
+
+        offset = ATLAS.HEADER.size
+        for i in range(0, sheetCount):
+            sheetCrc, page, x, y, width, height = ATLAS.SHEET.unpack_from(self._data, offset)
+            name, offset = _unpackString(self._data, offset + ATLAS.SHEET.size)
+            #A sheet edited since the atlas was built falls back to its own texture
+            path = os.path.join(PACK.ROOT, name)
+            if assetExists(path) and assetChecksum(path) == sheetCrc:
+                self._sheets[name] = (page, x, y, width, height)
+            else:
+                self._stale += 1
+        for i in range(0, pageCount):
+            size, = struct.unpack_from("<I", self._data, offset)
+            self._pages.append((offset + 4, size))
+            offset += 4 + size
+        if offset > len(self._data):
+            raise ValueError("Texture atlas is truncated: " + path)
+
+    def getPath(self):
+        return self._path
+
+    def getPageSize(self):
+        return self._pageSize
+
+    def getPageCount(self):
+        return len(self._pages)
+
+    def getNames(self):
+        return list(self._sheets)
+
+    def getStaleCount(self):
+        return self._stale
+
+    def getSheet(self, filePath):
+        return self._sheets.get(assetName(filePath))
+
+    def readPage(self, page):
+        offset, size = self._pages[page]
+        return zlib.decompress(self._data[offset:offset + size])
+
+
+_textureAtlas = None
+_textureAtlasLock = threading.Lock()
+
+def getTextureAtlas():
+    global _textureAtlas
+    with _textureAtlasLock:
+        if _textureAtlas is None:
+            _textureAtlas = False
+            if os.path.exists(ATLAS.PATH):
+                try:
+                    _textureAtlas = TextureAtlas(ATLAS.PATH)
+                except (OSError, ValueError, struct.error, zlib.error) as e:
+                    print("\nWarning: ignoring texture atlas: " + str(e) + "\n")
+        return _textureAtlas or None
+
+
 class Graphics(object):
     def __init__(self):
+        initSubsystems(SDL_INIT_VIDEO)
         self._window = POINTER(SDL_Window)()
         self._renderer = POINTER(SDL_Renderer)()
         self._spriteSheets = {}
-        SDL_CreateWindowAndRenderer(GLOBAL.SCREEN_WIDTH, GLOBAL.SCREEN_HEIGHT, 0, byref(self._window), byref(self._renderer))
-        SDL_SetWindowTitle(self._window, b"Cavestory")
+        self._textures = OrderedDict()
+        self._textureBytes = 0
+        self._textureBudget = RENDER.TEXTURE_BUDGET
+        self._sourceRect = SDL_Rect()
+        self._destinationRect = SDL_Rect()
+        self._window = SDL_CreateWindow(b"Cavestory", SDL_WINDOWPOS_UNDEFINED, SDL_WINDOWPOS_UNDEFINED, GLOBAL.SCREEN_WIDTH, GLOBAL.SCREEN_HEIGHT, 0)
+        self._renderer = SDL_CreateRenderer(self._window, -1, SDL_RENDERER_PRESENTVSYNC if LOOP.VSYNC else 0)
+        info = SDL_RendererInfo()
+        #Some renderers report PRESENTVSYNC whether or not it was asked for, so only trust it when requested
+        self._vsync = LOOP.VSYNC and SDL_GetRendererInfo(self._renderer, byref(info)) == 0 and (info.flags & SDL_RENDERER_PRESENTVSYNC) != 0
+        self._batch = RenderBatch() if RENDER.BATCH and supportsRenderGeometry(self._renderer) else None
         
     
     def __del__(self):
+        for texture, refCount, size in self._textures.values():
+            SDL_DestroyTexture(texture)
+        self._textures.clear()
         SDL_DestroyWindow(self._window)
         SDL_DestroyRenderer(self._renderer)
 
     def loadImage(self, filePath):
         if filePath not in self._spriteSheets:
-                self._spriteSheets[filePath] = sdl2.ext.load_image(filePath)
+            self._spriteSheets[filePath] = loadImageSurface(filePath)
 
         return self._spriteSheets[filePath]
 
+    def acquireTexture(self, filePath):
+        return self._acquireTexture(os.path.normpath(filePath), lambda: SDL_CreateTextureFromSurface(self._renderer, self.loadImage(filePath)))
+
+    def acquireSheet(self, filePath):
+        atlas = getTextureAtlas()
+        sheet = atlas.getSheet(filePath) if atlas is not None else None
+        if sheet is None:
+            return self.acquireTexture(filePath), 0, 0
+
+        page = sheet[0]
+        return self._acquireTexture("%s#%d" % (os.path.normpath(atlas.getPath()), page), lambda: self.createAtlasPage(atlas, page)), sheet[1], sheet[2]
+
+    def getBackgroundStrip(self, filePath, sourceY, height, repeatY):
+        surface = self.loadImage(filePath)
+        height = height or surface.h - sourceY
+        #Repeat the strip until it covers the screen, so any scroll offset needs at most two copies per axis
+        columns = -(-GLOBAL.SCREEN_WIDTH // (surface.w * GLOBAL.SPRITE_SCALE))
+        rows = -(-GLOBAL.SCREEN_HEIGHT // (height * GLOBAL.SPRITE_SCALE)) if repeatY else 1
+        return "%s#%d,%d,%d,%d" % (os.path.normpath(filePath), sourceY, height, columns, rows), surface, height, columns, rows
+
+    def acquireBackground(self, filePath, sourceY, height, repeatY):
+        key, surface, height, columns, rows = self.getBackgroundStrip(filePath, sourceY, height, repeatY)
+        texture = self._acquireTexture(key, lambda: self.createTiledTexture(surface, sourceY, height, columns, rows))
+        if texture is None:
+            return None, 0, 0
+        return texture, surface.w * columns, height * rows
+
+    def releaseBackground(self, filePath, sourceY, height, repeatY):
+        self._releaseTexture(self.getBackgroundStrip(filePath, sourceY, height, repeatY)[0])
+
+    def createTiledTexture(self, surface, sourceY, height, columns, rows):
+        strip = SDL_ConvertSurfaceFormat(surface, SDL_PIXELFORMAT_ARGB8888, 0)
+        tiled = SDL_CreateRGBSurfaceWithFormat(0, surface.w * columns, height * rows, 32, SDL_PIXELFORMAT_ARGB8888)
+        texture = None
+        if strip and tiled:
+            SDL_SetSurfaceBlendMode(strip, SDL_BLENDMODE_NONE)
+            source = SDL_Rect(0, sourceY, surface.w, height)
+            for row in range(0, rows):
+                for column in range(0, columns):
+                    SDL_BlitSurface(strip, source, tiled, SDL_Rect(column * surface.w, row * height))
+            texture = SDL_CreateTextureFromSurface(self._renderer, tiled)
+        if strip:
+            SDL_FreeSurface(strip)
+        if tiled:
+            SDL_FreeSurface(tiled)
+        return texture
+
+    def createAtlasPage(self, atlas, page):
+        size = atlas.getPageSize()
+        texture = SDL_CreateTexture(self._renderer, SDL_PIXELFORMAT_ARGB8888, SDL_TEXTUREACCESS_STATIC, size, size)
+        if texture:
+            SDL_UpdateTexture(texture, None, atlas.readPage(page), size * 4)
+            SDL_SetTextureBlendMode(texture, SDL_BLENDMODE_BLEND)
+        return texture
+
+    def _acquireTexture(self, key, create):
+        entry = self._textures.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self._textures.move_to_end(key)
+            return entry[0]
+
+        texture = create()
+        if not texture:
+            return None
+
+        width, height = c_int(0), c_int(0)
+        SDL_QueryTexture(texture, None, None, byref(width), byref(height))
+        size = width.value * height.value * 4
+        self._textures[key] = [texture, 1, size]
+        self._textureBytes += size
+        self.evictTextures()
+        return texture
+
+    def releaseTexture(self, filePath):
+        self._releaseTexture(os.path.normpath(filePath))
+
+    def releaseSheet(self, filePath):
+        atlas = getTextureAtlas()
+        sheet = atlas.getSheet(filePath) if atlas is not None else None
+        if sheet is None:
+            self.releaseTexture(filePath)
+        else:
+            self._releaseTexture("%s#%d" % (os.path.normpath(atlas.getPath()), sheet[0]))
+
+    def _releaseTexture(self, key):
+        entry = self._textures.get(key)
+        if entry is None or entry[1] == 0:
+            return
+
+        entry[1] -= 1
+        if entry[1] == 0:
+            self.evictTextures()
+
+    def evictTextures(self, budget = None):
+        if budget is None:
+            budget = self._textureBudget
+        if budget is None:
+            return
+
+        for key in list(self._textures.keys()):
+            if self._textureBytes <= budget:
+                break
+            texture, refCount, size = self._textures[key]
+            if refCount == 0:
+                SDL_DestroyTexture(texture)
+                del self._textures[key]
+                self._textureBytes -= size
+
+    def purgeTextures(self):
+        self.evictTextures(0)
+
     def blitSurface(self, texture, sourceRectangle, destinationRectangle):
+        self.flushBatch()
         SDL_RenderCopy(self._renderer, texture, sourceRectangle, destinationRectangle)
 
+    def drawQuad(self, texture, sourceX, sourceY, sourceWidth, sourceHeight, x, y, width, height):
+        if self._batch is not None:
+            self._batch.add(self._renderer, texture, sourceX, sourceY, sourceWidth, sourceHeight, x, y, width, height)
+            return
+
+        source = self._sourceRect
+        source.x, source.y, source.w, source.h = sourceX, sourceY, sourceWidth, sourceHeight
+        destination = self._destinationRect
+        destination.x, destination.y, destination.w, destination.h = x, y, width, height
+        SDL_RenderCopy(self._renderer, texture, source, destination)
+
+    def flushBatch(self):
+        if self._batch is not None:
+            self._batch.flush(self._renderer)
+
     def flip(self):
+        self.flushBatch()
         SDL_RenderPresent(self._renderer)
 
+    def hasVSync(self):
+        return self._vsync
+
+    def fillRect(self, x, y, width, height, color):
+        self.flushBatch()
+        r, g, b, a = c_uint8(), c_uint8(), c_uint8(), c_uint8()
+        SDL_GetRenderDrawColor(self._renderer, byref(r), byref(g), byref(b), byref(a))
+        destination = self._destinationRect
+        destination.x, destination.y, destination.w, destination.h = x, y, width, height
+        SDL_SetRenderDrawColor(self._renderer, color[0], color[1], color[2], color[3])
+        SDL_RenderFillRect(self._renderer, destination)
+        SDL_SetRenderDrawColor(self._renderer, r, g, b, a)
+
     def clear(self):
         SDL_RenderClear(self._renderer)
 
 
 class Level(object):
-    def __init__(self, mapName, spawnPoint, graphics):
+    def __init__(self, mapName, spawnPoint, graphics = None, data = None):
         self._mapName = mapName
         self._spawnPoint = spawnPoint
         self._size = Vector2(0, 0)
-        self.loadMap(mapName, graphics)
+        self._chunks = []
+        self._tileClasses = None
+        self._scripts = []
+        self.loadMap(mapName, data)
+        self.buildTileCells()
+        if graphics is not None:
+            self.createTextures(graphics)
 
 
     def update(self, elapsedTime):
         pass
 
-    def draw(self, graphics):
-        for i in range(0, len(self._tileList)):
-            self._tileList[i].draw(graphics)
+    def draw(self, graphics, camera):
+        if len(self._chunks) == 0:
+            tileWidth = self._tileSize.x * GLOBAL.SPRITE_SCALE
+            tileHeight = self._tileSize.y * GLOBAL.SPRITE_SCALE
+            firstColumn, lastColumn = camera.getVisibleRange(camera.getLeft(), camera.getRight(), tileWidth, self._size.x)
+            firstRow, lastRow = camera.getVisibleRange(camera.getTop(), camera.getBottom(), tileHeight, self._size.y)
+            for ty in range(firstRow, lastRow):
+                for tx in range(firstColumn, lastColumn):
+                    for tile in self._tileCells[ty * self._size.x + tx]:
+                        tile.draw(graphics, -camera.getLeft(), -camera.getTop())
+            return
+
+        firstColumn, lastColumn = camera.getVisibleRange(camera.getLeft(), camera.getRight(), self._chunkSize.x, self._chunkColumns)
+        firstRow, lastRow = camera.getVisibleRange(camera.getTop(), camera.getBottom(), self._chunkSize.y, self._chunkRows)
+        for cy in range(firstRow, lastRow):
+            for cx in range(firstColumn, lastColumn):
+                if self._chunks[cy * self._chunkColumns + cx][0] is None and not self.bakeChunk(graphics, cy * self._chunkColumns + cx):
+                    return
+
+        for cy in range(firstRow, lastRow):
+            for cx in range(firstColumn, lastColumn):
+                texture, chunkRect = self._chunks[cy * self._chunkColumns + cx]
+                graphics.drawQuad(texture, 0, 0, chunkRect.w, chunkRect.h, chunkRect.x - camera.getLeft(), chunkRect.y - camera.getTop(), chunkRect.w, chunkRect.h)
+
+        #Bake a few off-screen chunks per frame so scrolling into them later doesn't stall
+        for i in range(0, RENDER.BAKE_CHUNKS_PER_FRAME):
+            if len(self._pendingChunks) == 0:
+                break
+            index = self._pendingChunks.pop()
+            if self._chunks[index][0] is None and not self.bakeChunk(graphics, index):
+                return
+
+    def buildTileCells(self):
+        tileWidth = self._tileSize.x * GLOBAL.SPRITE_SCALE
+        tileHeight = self._tileSize.y * GLOBAL.SPRITE_SCALE
+        self._tileCells = [[] for i in range(0, self._size.x * self._size.y)]
+        for tile in self._tileList:
+            tx = int(tile._position.x) // tileWidth
+            ty = int(tile._position.y) // tileHeight
+            if 0 <= tx < self._size.x and 0 <= ty < self._size.y:
+                self._tileCells[ty * self._size.x + tx].append(tile)
+
+    def getPixelWidth(self):
+        return self._size.x * self._tileSize.x * GLOBAL.SPRITE_SCALE
+
+    def getPixelHeight(self):
+        return self._size.y * self._tileSize.y * GLOBAL.SPRITE_SCALE
+
+    def createTextures(self, graphics):
+        for tileset in self._tilesets:
+            tileset.Texture = graphics.acquireTexture(tileset.Path)
+        if RENDER.BAKE_LAYERS:
+            self.bakeLayers(graphics)
+
+    def bakeLayers(self, graphics):
+        self.destroyChunks()
+        renderer = graphics._renderer
+        if not renderer or not SDL_RenderTargetSupported(renderer):
+            return
+
+        chunkWidth = RENDER.CHUNK_TILES * self._tileSize.x * GLOBAL.SPRITE_SCALE
+        chunkHeight = RENDER.CHUNK_TILES * self._tileSize.y * GLOBAL.SPRITE_SCALE
+        mapWidth = self.getPixelWidth()
+        mapHeight = self.getPixelHeight()
+        self._chunkSize = Vector2(chunkWidth, chunkHeight)
+        self._chunkColumns = -(-mapWidth // chunkWidth)
+        self._chunkRows = -(-mapHeight // chunkHeight)
+
+        self._chunkTiles = [[] for i in range(0, self._chunkColumns * self._chunkRows)]
+        for tile in self._tileList:
+            cx = int(tile._position.x) // chunkWidth
+            cy = int(tile._position.y) // chunkHeight
+            if 0 <= cx < self._chunkColumns and 0 <= cy < self._chunkRows:
+                self._chunkTiles[cy * self._chunkColumns + cx].append(tile)
+
+        for cy in range(0, self._chunkRows):
+            for cx in range(0, self._chunkColumns):
+                x, y = cx * chunkWidth, cy * chunkHeight
+                self._chunks.append([None, SDL_Rect(x, y, min(chunkWidth, mapWidth - x), min(chunkHeight, mapHeight - y))])
+        self._pendingChunks = list(range(len(self._chunks) - 1, -1, -1))
+
+    def bakeChunk(self, graphics, index):
+        renderer = graphics._renderer
+        chunkRect = self._chunks[index][1]
+        texture = SDL_CreateTexture(renderer, SDL_PIXELFORMAT_RGBA8888, SDL_TEXTUREACCESS_TARGET, chunkRect.w, chunkRect.h)
+        if not texture:
+            print("\nError: Unable to create layer texture\n")
+            self.destroyChunks()
+            return False
+
+        graphics.flushBatch()
+        SDL_SetTextureBlendMode(texture, SDL_BLENDMODE_BLEND)
+        SDL_SetRenderTarget(renderer, texture)
+        SDL_SetRenderDrawColor(renderer, 0, 0, 0, 0)
+        SDL_RenderClear(renderer)
+        for tile in self._chunkTiles[index]:
+            tile.draw(graphics, -chunkRect.x, -chunkRect.y)
+        graphics.flushBatch()
+        SDL_SetRenderTarget(renderer, None)
+        SDL_SetRenderDrawColor(renderer, 0, 0, 0, 255)
+        self._chunks[index][0] = texture
+        return True
+
+    def destroyChunks(self):
+        for texture, destRect in self._chunks:
+            if texture is not None:
+                SDL_DestroyTexture(texture)
+        self._chunks = []
+        self._pendingChunks = []
+
+    def unload(self, graphics):
+        self.destroyChunks()
+        for tileset in self._tilesets:
+            graphics.releaseTexture(tileset.Path)
+        self._tilesets = []
 
     def checkTileCollisions(self, other):
         others = []
-        for i in range(0, len(self._collisionRects)):
+        for i in self._collisionGrid.query(other.getLeft(), other.getTop(), other.getRight(), other.getBottom()):
             if self._collisionRects[i].collidesWith(other):
                 others.append(self._collisionRects[i])
         return others
 
     def checkSlopeCollisions(self, other):
         others = []
-        for i in range(0, len(self._slopes)):
+        for i in self._slopeGrid.query(other.getLeft(), other.getTop(), other.getRight(), other.getBottom()):
             if self._slopes[i].collidesWith(other):
                 others.append(self._slopes[i])
         
         return others
 
+    def getScripts(self):
+        return self._scripts
+
+    def usesTileGrid(self):
+        return self._tileClasses is not None
+
+    def checkTileGridCollisions(self, other):
+        solids = []
+        slopes = []
+        tileSize = self._tileSize.x * GLOBAL.SPRITE_SCALE
+        width = self._size.x
+        height = self._size.y
+        firstColumn = int(other.getLeft() // tileSize)
+        lastColumn = int(other.getRight() // tileSize)
+        for ty in range(int(other.getTop() // tileSize), int(other.getBottom() // tileSize) + 1):
+            row = ty * width
+            for tx in range(firstColumn, lastColumn + 1):
+                #Tiles past the edge of the map are solid, so nothing walks or falls out of the stage
+                if tx < 0 or tx >= width or ty < 0 or ty >= height:
+                    solids.append((tx, ty))
+                    continue
+                tileClass = self._tileClasses[row + tx]
+                if tileClass == TILE_CLASS.SOLID:
+                    solids.append((tx, ty))
+                elif tileClass == TILE_CLASS.FLOOR_SLOPE or tileClass == TILE_CLASS.CEILING_SLOPE:
+                    leftY, rightY = SLOPE_LINES[self._tileSlopes[row + tx]]
+                    slopes.append((tx, ty, leftY * GLOBAL.SPRITE_SCALE, rightY * GLOBAL.SPRITE_SCALE, tileClass == TILE_CLASS.FLOOR_SLOPE))
+        return solids, slopes
+
+    def pointsInSolid(self, xs, ys, out, cells, coordinates):
+        #cells (intp) and coordinates (float32) are caller-owned scratch as long as xs, so a query allocates nothing
+        if self._solidCells is not None:
+            #Clamp to the empty border of the padded grid, so points off the map are never solid
+            tileSize = self._tileSize.x * GLOBAL.SPRITE_SCALE
+            width = self._size.x
+            np.floor_divide(xs, tileSize, out = coordinates)
+            np.clip(coordinates, -1, width, out = coordinates)
+            np.copyto(cells, coordinates, casting = "unsafe")
+            np.floor_divide(ys, tileSize, out = coordinates)
+            np.clip(coordinates, -1, self._size.y, out = coordinates)
+            np.multiply(coordinates, width + 2, out = coordinates)
+            np.add(cells, coordinates, out = cells, casting = "unsafe")
+            np.add(cells, width + 3, out = cells)
+            return np.take(self._solidCells, cells, out = out)
+
+        #One row per point, one column per rectangle; sized on the first query after a level loads
+        if self._rectHits is None or self._rectHits.shape[0] != len(xs):
+            self._rectHits = np.zeros((len(xs), self._solidRects.shape[1]), dtype = np.bool_)
+            self._rectScratch = np.zeros_like(self._rectHits)
+        rects, hits, scratch = self._solidRects, self._rectHits, self._rectScratch
+        np.greater_equal.outer(xs, rects[0], out = hits)
+        hits &= np.less.outer(xs, rects[2], out = scratch)
+        hits &= np.greater_equal.outer(ys, rects[1], out = scratch)
+        hits &= np.less.outer(ys, rects[3], out = scratch)
+        return np.any(hits, axis = 1, out = out)
+
+    def getBackground(self):
+        return BACKGROUND.MAP_PATH, BACKGROUND_MODE.PARALLAX
+
+    def getNpcs(self):
+        return None
+
+    def spawnEntities(self, flags):
+        pass
+
+    def buildCollisionGrids(self):
+        cellSize = max(self._tileSize.x, self._tileSize.y, 1) * GLOBAL.SPRITE_SCALE
+        self._collisionGrid = SpatialGrid(cellSize)
+        for i in range(0, len(self._collisionRects)):
+            rect = self._collisionRects[i]
+            self._collisionGrid.insert(i, rect.getLeft(), rect.getTop(), rect.getRight(), rect.getBottom())
+
+        #Left, top, right and bottom edges as rows, so pointsInSolid can broadcast each against every point
+        self._solidRects = np.array([(rect.getLeft(), rect.getTop(), rect.getRight(), rect.getBottom()) for rect in self._collisionRects], dtype = np.float32).reshape(-1, 4).T.copy()
+        self._rectHits = None
+        self._solidCells = None
+        if self._tileClasses is not None:
+            solid = np.zeros((self._size.y + 2, self._size.x + 2), dtype = np.bool_)
+            solid[1:-1, 1:-1] = np.frombuffer(self._tileClasses, dtype = np.uint8).reshape(self._size.y, self._size.x) == TILE_CLASS.SOLID
+            self._solidCells = solid.ravel()
+
+        self._slopeGrid = SpatialGrid(cellSize)
+        for i in range(0, len(self._slopes)):
+            p1, p2 = self._slopes[i]._p1, self._slopes[i]._p2
+            self._slopeGrid.insert(i, min(p1.x, p2.x), min(p1.y, p2.y), max(p1.x, p2.x), max(p1.y, p2.y))
+
         
-    def loadMap(self, mapName, graphics):
+    def loadMap(self, mapName, compiled = None):
+        if compiled is not None:
+            self.loadCompiled(compiled)
+            return
+
+        #Hold the cached level while reading its views, so a reload on another thread can't unmap them
+        compiled = levelCache.acquire(mapName)
+        try:
+            self.loadCompiled(compiled)
+        finally:
+            levelCache.release(compiled)
+
+    def loadCompiled(self, compiled):
         self._tilesets = []
         self._tileList = []
         self._collisionRects = []
         self._slopes = []
-        ss = PATHNAME + "/../Resources/maps/" + mapName + ".tmx"
-        #ss = "/home/derek/Programming/Python/CavestoryRemake/Resources/maps/" + mapName + ".tmx"
-        doc = untangle.parse(ss)
+        self._size = Vector2(compiled.width, compiled.height)
+        self._tileSize = Vector2(compiled.tileWidth, compiled.tileHeight)
+        width = compiled.width
+        tileWidth, tileHeight = compiled.tileWidth, compiled.tileHeight
+
+        tilesets = sorted(compiled.tilesets)
+        for firstgid, source, columns, margin, spacing in tilesets:
+            self._tilesets.append(Tileset(None, firstgid, LEVEL_CACHE.MAPS_DIRECTORY + source))
+        firstGids = np.array([tileset[0] for tileset in tilesets], dtype = np.int64)
+        columns = np.array([max(1, tileset[2]) for tileset in tilesets], dtype = np.int64)
+        margins = np.array([tileset[3] for tileset in tilesets], dtype = np.int64)
+        spacings = np.array([tileset[4] for tileset in tilesets], dtype = np.int64)
 
-        width, height = 0, 0
-        width = int(doc.map["width"])
-        height = int(doc.map["height"])
-        self._size = Vector2(width, height)
+        #Loading Layers
+        size = Vector2(tileWidth, tileHeight)
+        for layer in compiled.layers:
+            gids = np.asarray(layer, dtype = np.uint32)
+            indices = np.flatnonzero(gids)
+            gids = gids[indices].astype(np.int64)
+
+            #Each gid belongs to the tileset with the highest firstgid not above it
+            owners = np.searchsorted(firstGids, gids, side = "right") - 1
+            known = owners >= 0
+            indices, gids, owners = indices[known], gids[known], owners[known]
+            local = gids - firstGids[owners]
+            sourceX = margins[owners] + (local % columns[owners]) * (tileWidth + spacings[owners])
+            sourceY = margins[owners] + (local // columns[owners]) * (tileHeight + spacings[owners])
+
+            for owner, tx, ty, x, y in zip(owners.tolist(), sourceX.tolist(), sourceY.tolist(), ((indices % width) * tileWidth).tolist(), ((indices // width) * tileHeight).tolist()):
+                self._tileList.append(Tile(self._tilesets[owner], size, Vector2(tx, ty), Vector2(x, y)))
 
-        tileWidth, tileHeight = 0, 0
-        tileWidth = int(doc.map["tilewidth"])
-        tileHeight = int(doc.map["tileheight"])
-        self._tileSize = Vector2(tileWidth, tileHeight)
+        #Load Collisions
+        rects = compiled.collisionRects
+        for i in range(0, len(rects), 4):
+            self._collisionRects.append(Rectangle(rects[i], rects[i + 1], rects[i + 2], rects[i + 3]))
 
-        try:
-            if len(doc.map.tileset) == 0:
-                firstgid = 0
-                source = doc.map.tileset["source"]
-                xmlPath = PATHNAME + "/../Resources/maps/" + source
-                xmlss = untangle.parse(xmlPath)
-                ss = PATHNAME + "/../Resources/maps/" + xmlss.tileset.image["source"]
-                #ss = source
-                firstgid = int(doc.map.tileset["firstgid"])
-                tex = SDL_CreateTextureFromSurface(graphics._renderer, graphics.loadImage(ss))
-                self._tilesets.append(Tileset(tex, firstgid))
+        slopes = compiled.slopes
+        for i in range(0, len(slopes), 4):
+            self._slopes.append(Slope(Vector2(slopes[i], slopes[i + 1]), Vector2(slopes[i + 2], slopes[i + 3])))
 
-            else:
-                for i in range(0, len(doc.map.tileset)):
-                    firstgid = 0
-                    source = doc.map.tileset[i]["source"]
-                    xmlPath = PATHNAME + "/../Resources/maps/" + source
-                    xmlss = untangle.parse(xmlPath)
-                    ss = PATHNAME + "/../Resources/maps/" + xmlss.tileset.image["source"]
-                    #ss = source
-                    firstgid = int(doc.map.tileset[i]["firstgid"])
-                    tex = SDL_CreateTextureFromSurface(graphics._renderer, graphics.loadImage(ss))
-                    self._tilesets.append(Tileset(tex, firstgid))
-
-        except AttributeError:
-            pass
+        for name, x, y in compiled.spawnPoints:
+            if name == "player":
+                self._spawnPoint = Vector2(x, y)
 
-        #Loading Layers
+        self.buildCollisionGrids()
 
-        try:
-            for k in range(0, len(doc.map.layer)): #len(doc.map)
+
+class CompiledLevel(object):
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.tileWidth = 0
+        self.tileHeight = 0
+        self.dependencies = []
+        self.tilesets = []
+        self.layers = []
+        self.collisionRects = []
+        self.slopes = []
+        self.spawnPoints = []
+        self._map = None
+        self._view = None
+        self._users = 0
+        self._retired = False
+
+    def isCurrent(self):
+        for path, mtime in self.dependencies:
+            try:
+                if assetVersion(LEVEL_CACHE.MAPS_DIRECTORY + path) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def close(self):
+        if self._map is None:
+            return
+
+        for view in self.layers + [self.collisionRects, self.slopes, self._view]:
+            view.release()
+        self.layers = []
+        self.collisionRects = []
+        self.slopes = []
+        self._view = None
+        self._map.close()
+        self._map = None
+
+    def write(self, cachePath):
+        header = LEVEL_CACHE.HEADER.pack(LEVEL_CACHE.MAGIC, LEVEL_CACHE.VERSION, self.width, self.height, self.tileWidth, self.tileHeight,
+            len(self.dependencies), len(self.tilesets), len(self.layers), len(self.collisionRects) // 4, len(self.slopes) // 4, len(self.spawnPoints))
+        chunks = [header]
+        for path, mtime in self.dependencies:
+            chunks.append(_packString(struct.pack("<q", mtime), path))
+        for firstgid, source, columns, margin, spacing in self.tilesets:
+            chunks.append(_packString(struct.pack("<iIHH", firstgid, columns, margin, spacing), source))
+        for name, x, y in self.spawnPoints:
+            chunks.append(_packString(struct.pack("<ii", x, y), name))
+
+        size = sum(len(chunk) for chunk in chunks)
+        chunks.append(bytes(-size % 4))
+        for gids in self.layers:
+            chunks.append(struct.pack("<I", len(gids)))
+            chunks.append(np.asarray(gids, dtype = "<u4").tobytes())
+        chunks.append(array.array("i", self.collisionRects).tobytes())
+        chunks.append(array.array("i", self.slopes).tobytes())
+
+        os.makedirs(os.path.dirname(cachePath), exist_ok = True)
+        tempPath = cachePath + ".tmp"
+        with open(tempPath, "wb") as f:
+            f.write(b"".join(chunks))
+        os.replace(tempPath, cachePath)
+
+
+def _packString(prefix, string):
+    data = string.encode("utf-8")
+    return prefix + struct.pack("<H", len(data)) + data
+
+def _unpackString(view, offset):
+    length, = struct.unpack_from("<H", view, offset)
+    offset += 2
+    return bytes(view[offset:offset + length]).decode("utf-8"), offset + length
+
+def readCompiledLevel(cachePath):
+    try:
+        with open(cachePath, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    view = memoryview(mapped)
+    level = CompiledLevel()
+    try:
+        magic, version, width, height, tileWidth, tileHeight, numDependencies, numTilesets, numLayers, numRects, numSlopes, numSpawns = LEVEL_CACHE.HEADER.unpack_from(view, 0)
+        if magic != LEVEL_CACHE.MAGIC or version != LEVEL_CACHE.VERSION:
+            raise ValueError(cachePath)
+
+        level.width, level.height = width, height
+        level.tileWidth, level.tileHeight = tileWidth, tileHeight
+        offset = LEVEL_CACHE.HEADER.size
+        for i in range(0, numDependencies):
+            mtime, = struct.unpack_from("<q", view, offset)
+            path, offset = _unpackString(view, offset + 8)
+            level.dependencies.append((path, mtime))
+        for i in range(0, numTilesets):
+            firstgid, columns, margin, spacing = struct.unpack_from("<iIHH", view, offset)
+            source, offset = _unpackString(view, offset + 12)
+            level.tilesets.append((firstgid, source, columns, margin, spacing))
+        for i in range(0, numSpawns):
+            x, y = struct.unpack_from("<ii", view, offset)
+            name, offset = _unpackString(view, offset + 8)
+            level.spawnPoints.append((name, x, y))
+
+        offset += -offset % 4
+        for i in range(0, numLayers):
+            count, = struct.unpack_from("<I", view, offset)
+            offset += 4
+            level.layers.append(view[offset:offset + count * 4].cast("I"))
+            offset += count * 4
+        level.collisionRects = view[offset:offset + numRects * 16].cast("i")
+        offset += numRects * 16
+        level.slopes = view[offset:offset + numSlopes * 16].cast("i")
+        offset += numSlopes * 16
+        if offset != len(view):
+            raise ValueError(cachePath)
+
+    except (struct.error, ValueError, TypeError, UnicodeDecodeError):
+        #Unmap before returning, so the caller can replace the file with a fresh cache
+        for partial in level.layers + [level.collisionRects, level.slopes]:
+            if partial.__class__ is memoryview:
+                partial.release()
+        view.release()
+        mapped.close()
+        return None
+
+    level._map = mapped
+    level._view = view
+    return level
+
+def decodeTmxLayer(data, count):
+    encoding = data["encoding"]
+    compression = data["compression"]
+    if encoding is None:
+        gids = np.array([int(tile["gid"] or 0) for tile in data.get_elements("tile")], dtype = np.uint32)
+    elif encoding == "csv":
+        gids = np.array(data.cdata.split(","), dtype = np.uint32) if data.cdata.strip() else np.zeros(0, dtype = np.uint32)
+    elif encoding == "base64":
+        raw = base64.b64decode(data.cdata)
+        if compression == "zlib":
+            raw = zlib.decompress(raw)
+        elif compression == "gzip":
+            raw = gzip.decompress(raw)
+        elif compression:
+            raise ValueError("Unsupported TMX layer compression: " + compression)
+        gids = np.frombuffer(raw, dtype = "<u4").astype(np.uint32)
+    else:
+        raise ValueError("Unsupported TMX layer encoding: " + encoding)
+
+    if len(gids) != count:
+        raise ValueError("TMX layer has %d tiles, expected %d" % (len(gids), count))
+    return gids & TMX.GID_MASK
+
+def compileTmx(mapPath):
+    import untangle
+    level = CompiledLevel()
+    doc = untangle.parse(bytes(readAsset(LEVEL_CACHE.MAPS_DIRECTORY + mapPath)).decode("utf-8"))
+    level.dependencies.append((mapPath, assetVersion(LEVEL_CACHE.MAPS_DIRECTORY + mapPath)))
+
+    level.width = int(doc.map["width"])
+    level.height = int(doc.map["height"])
+    level.tileWidth = int(doc.map["tilewidth"])
+    level.tileHeight = int(doc.map["tileheight"])
+
+    for tileset in doc.map.get_elements("tileset"):
+        source = tileset["source"]
+        if source is None:
+            element = tileset
+        else:
+            element = untangle.parse(bytes(readAsset(LEVEL_CACHE.MAPS_DIRECTORY + source)).decode("utf-8")).tileset
+            level.dependencies.append((source, assetVersion(LEVEL_CACHE.MAPS_DIRECTORY + source)))
+        margin = int(element["margin"] or 0)
+        spacing = int(element["spacing"] or 0)
+        if element["columns"] is not None:
+            columns = int(element["columns"])
+        else:
+            columns = (int(element.image["width"]) - 2 * margin + spacing) // (int(element["tilewidth"]) + spacing)
+        level.tilesets.append((int(tileset["firstgid"]), element.image["source"], columns, margin, spacing))
+
+    #Loading Layers
+    for layer in doc.map.get_elements("layer"):
+        level.layers.append(decodeTmxLayer(layer.data, int(layer["width"]) * int(layer["height"])))
+
+    #Load Collisions
+    for group in doc.map.get_elements("objectgroup"):
+        name = group["name"]
+        if name == "collisions":
+            for obj in group.get_elements("object"):
+                x = float(obj["x"])
+                y = float(obj["y"])
+                width = float(obj["width"])
+                height = float(obj["height"])
+                level.collisionRects.extend((math.ceil(x) * GLOBAL.SPRITE_SCALE, math.ceil(y) * GLOBAL.SPRITE_SCALE, math.ceil(width) * GLOBAL.SPRITE_SCALE, math.ceil(height) * GLOBAL.SPRITE_SCALE))
+        if name == "slopes":
+            for obj in group.get_elements("object"):
+                points = []
+                p1 = Vector2(math.ceil(float(obj["x"])), math.ceil(float(obj["y"])))
+                for pair in obj.polyline["points"].split(' '):
+                    ps = pair.split(",")
+                    points.append(Vector2(int(math.ceil(float(ps[0]))), int(math.ceil(float(ps[1])))))
+
+                for k in range(0, len(points), 2):
+                    a, b = (points[k], points[k + 1]) if k < 2 else (points[k - 1], points[k])
+                    level.slopes.extend(((p1.x + a.x) * GLOBAL.SPRITE_SCALE, (p1.y + a.y) * GLOBAL.SPRITE_SCALE, (p1.x + b.x) * GLOBAL.SPRITE_SCALE, (p1.y + b.y) * GLOBAL.SPRITE_SCALE))
+        if name == "spawn points":
+            for obj in group.get_elements("object"):
+                x = float(obj["x"])
+                y = float(obj["y"])
+                level.spawnPoints.append((obj["name"] or "", math.ceil(x) * GLOBAL.SPRITE_SCALE, math.ceil(y) * GLOBAL.SPRITE_SCALE))
+
+    return level
+
+
+class LevelCache(object):
+    def __init__(self, directory = LEVEL_CACHE.DIRECTORY):
+        self._directory = directory
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, mapName):
+        with self._lock:
+            level = self._load(mapName)
+            level._users += 1
+            return level
+
+    def release(self, level):
+        with self._lock:
+            level._users -= 1
+            if level._retired and level._users == 0:
+                level.close()
+
+    def _retire(self, level):
+        #A stale level still being read is closed by its last release instead
+        level._retired = True
+        if level._users == 0:
+            level.close()
+
+    def _load(self, mapName):
+        level = self._levels.get(mapName)
+        if level is not None and level.isCurrent():
+            return level
+
+        cachePath = self._directory + mapName + ".lvl"
+        if level is None:
+            level = readCompiledLevel(cachePath)
+        if level is not None and not level.isCurrent():
+            self._retire(level)
+            level = None
+
+        if level is None:
+            level = compileTmx(mapName + ".tmx")
+            try:
+                level.write(cachePath)
+                level = readCompiledLevel(cachePath) or level
+            except OSError:
+                pass
+
+        self._levels[mapName] = level
+        return level
+
+levelCache = LevelCache()
+
+
+class StageData(object):
+    def __init__(self, stageName, tilesetName):
+        self.stageName = stageName
+        self.tilesetName = tilesetName
+        self.width = 0
+        self.height = 0
+        self.tiles = None
+        self.attributes = None
+        self.collision = None
+        self.entities = None
+
+    def tileAttributes(self):
+        return self.attributes[self.tiles]
+
+
+def _mapFile(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+def getStageTileset(stageName):
+    number = STAGE_NUMBERS.get(stageName)
+    if number is None:
+        raise ValueError("Stage %s has no entry in the stage table" % stageName)
+    return STAGE_TABLE[number][1]
+
+def loadStageData(stageName, tilesetName = None):
+    if tilesetName is None:
+        tilesetName = getStageTileset(stageName)
+    stage = StageData(stageName, tilesetName)
+
+    pxm = readAsset(STAGE.DIRECTORY + stageName + ".pxm")
+    if pxm[0:4] != STAGE.PXM_MAGIC:
+        raise ValueError("Not a PXM map: " + stageName)
+    stage.width, stage.height = struct.unpack_from("<HH", pxm, 4)
+    stage.tiles = np.frombuffer(pxm, dtype = np.uint8, count = stage.width * stage.height, offset = 8).reshape(stage.height, stage.width)
+
+    stage.attributes = np.zeros(256, dtype = np.uint8)
+    pxa = np.frombuffer(readAsset(STAGE.DIRECTORY + tilesetName + ".pxa"), dtype = np.uint8)[0:256]
+    stage.attributes[0:len(pxa)] = pxa
+    stage.collision = getTileClassTable()[stage.attributes][stage.tiles]
+
+    pxePath = STAGE.DIRECTORY + stageName + ".pxe"
+    if assetExists(pxePath):
+        pxe = readAsset(pxePath)
+        if pxe[0:4] != STAGE.PXE_MAGIC:
+            raise ValueError("Not a PXE entity list: " + stageName)
+        count, = struct.unpack_from("<I", pxe, 4)
+        stage.entities = np.frombuffer(pxe, dtype = STAGE_ENTITY, count = count, offset = 8)
+    else:
+        stage.entities = np.zeros(0, dtype = STAGE_ENTITY)
+
+    return stage
+
+def listStages():
+    pack = getAssetPack()
+    if pack is not None:
+        prefix = assetName(STAGE.DIRECTORY) + "/"
+        fileNames = [name[len(prefix):] for name in pack.getNames() if name.startswith(prefix) and "/" not in name[len(prefix):]]
+    else:
+        fileNames = os.listdir(STAGE.DIRECTORY)
+    return sorted(fileName[:-4] for fileName in fileNames if fileName.endswith(".pxm"))
+
+def loadAllStages():
+    stages = {}
+    for stageName in listStages():
+        if stageName in STAGE_NUMBERS:
+            stages[stageName] = loadStageData(stageName)
+    return stages
+
+def isStage(mapName):
+    return not assetExists(LEVEL_CACHE.MAPS_DIRECTORY + mapName + ".tmx") and assetExists(STAGE.DIRECTORY + mapName + ".pxm")
+
+
+class StageLevel(Level):
+    def loadMap(self, mapName, stage = None):
+        if stage is None:
+            stage = loadStageData(mapName)
+        self._stage = stage
+        self._size = Vector2(stage.width, stage.height)
+        self._tileSize = Vector2(STAGE.TILE_SIZE, STAGE.TILE_SIZE)
+        self._tileList = []
+        self._collisionRects = []
+        self._slopes = []
+
+        tilesetPath = STAGE.DIRECTORY + "Prt" + stage.tilesetName + ".pbm"
+        tileset = Tileset(None, 0, tilesetPath)
+        self._tilesets = [tileset]
+
+        size = STAGE.TILE_SIZE
+        rows, columns = np.nonzero(stage.tiles)
+        for y, x, t in zip(rows.tolist(), columns.tolist(), stage.tiles[rows, columns].tolist()):
+            tilesetPosition = Vector2((t % STAGE.TILESET_COLUMNS) * size, (t // STAGE.TILESET_COLUMNS) * size)
+            self._tileList.append(Tile(tileset, Vector2(size, size), tilesetPosition, Vector2(x * size, y * size)))
+
+        #Merge horizontal runs of solid tiles into collision rectangles
+        scale = size * GLOBAL.SPRITE_SCALE
+        solid = np.zeros((stage.height, stage.width + 2), dtype = np.int8)
+        solid[:, 1:-1] = stage.collision == TILE_CLASS.SOLID
+        edges = np.diff(solid, axis = 1)
+        starts = np.argwhere(edges == 1)
+        ends = np.argwhere(edges == -1)
+        for (y, x0), (y1, x1) in zip(starts.tolist(), ends.tolist()):
+            self._collisionRects.append(Rectangle(x0 * scale, y * scale, (x1 - x0) * scale, scale))
+
+        rows, columns = np.nonzero(stage.collision == TILE_CLASS.FLOOR_SLOPE)
+        for y, x in zip(rows.tolist(), columns.tolist()):
+            leftY, rightY = SLOPE_LINES[stage.attributes[stage.tiles[y, x]] & 0x07]
+            self._slopes.append(Slope(Vector2(x * scale, (y * size + leftY) * GLOBAL.SPRITE_SCALE), Vector2((x + 1) * scale, (y * size + rightY) * GLOBAL.SPRITE_SCALE)))
+
+        self._tileClasses = stage.collision.tobytes()
+        self._tileSlopes = (stage.tileAttributes() & 0x07).tobytes()
+        self.buildCollisionGrids()
+        self._spawnPoint = self.findStartPosition(self._spawnPoint)
+        self._scripts = loadStageScripts(mapName)
+        self._npcs = NpcSystem(getNpcTable())
+
+    def findStartPosition(self, spawnPoint):
+        #Stages carry no spawn point; start on the free tile above ground nearest the first door, or the requested point without one
+        stage = self._stage
+        scale = STAGE.TILE_SIZE * GLOBAL.SPRITE_SCALE
+        doors = stage.entities[stage.entities["type"] == STAGE.DOOR_NPC]
+        if len(doors) > 0:
+            x, y = int(doors["x"][0]), int(doors["y"][0])
+        else:
+            x, y = int(spawnPoint.x) // scale, int(spawnPoint.y) // scale
+
+        free = stage.collision == TILE_CLASS.NONE
+        standing = np.zeros_like(free)
+        standing[:-1] = free[:-1] & ((stage.collision[1:] == TILE_CLASS.SOLID) | (stage.collision[1:] == TILE_CLASS.FLOOR_SLOPE))
+        rows, columns = np.nonzero(standing if standing.any() else free)
+        if len(rows) == 0:
+            return spawnPoint
+        nearest = int(np.argmin((columns - x) ** 2 + (rows - y) ** 2))
+        return Vector2(int(columns[nearest]) * scale, int(rows[nearest]) * scale)
+
+    def getBackground(self):
+        name, mode = STAGE_TABLE[STAGE_NUMBERS[self._mapName]][2:]
+        return BACKGROUND.DIRECTORY + name + ".pbm", mode
+
+    def getNpcs(self):
+        return self._npcs
+
+    def spawnEntities(self, flags):
+        #Prefetched levels are built before the flags they load with are known, so entities spawn when the level is entered
+        self._npcs = NpcSystem(getNpcTable())
+        self._npcs.spawnStageEntities(self._stage.entities, flags)
+
+    def update(self, elapsedTime):
+        self._npcs.update(elapsedTime, self._stage.collision, self._tileSize.x * GLOBAL.SPRITE_SCALE)
+
+class NpcTable(object):
+    def __init__(self, data):
+        count = len(data) // 24
+        self.count = count
+        offset = 0
+        self.bits = np.frombuffer(data, dtype = "<u2", count = count, offset = offset)
+        offset += count * 2
+        self.life = np.frombuffer(data, dtype = "<u2", count = count, offset = offset)
+        offset += count * 2
+        self.surface = np.frombuffer(data, dtype = np.uint8, count = count, offset = offset)
+        offset += count
+        self.destroySound = np.frombuffer(data, dtype = np.uint8, count = count, offset = offset)
+        offset += count
+        self.hitSound = np.frombuffer(data, dtype = np.uint8, count = count, offset = offset)
+        offset += count
+        self.size = np.frombuffer(data, dtype = np.uint8, count = count, offset = offset)
+        offset += count
+        self.experience = np.frombuffer(data, dtype = "<i4", count = count, offset = offset)
+        offset += count * 4
+        self.damage = np.frombuffer(data, dtype = "<i4", count = count, offset = offset)
+        offset += count * 4
+        #front, top, back, bottom in unscaled pixels from the entity's centre
+        self.hitBoxes = np.frombuffer(data, dtype = np.uint8, count = count * 4, offset = offset).reshape(count, 4)
+        offset += count * 4
+        self.viewBoxes = np.frombuffer(data, dtype = np.uint8, count = count * 4, offset = offset).reshape(count, 4)
+
+_npcTable = None
+
+def getNpcTable():
+    global _npcTable
+    if _npcTable is None:
+        _npcTable = NpcTable(readAsset(NPC.TABLE_PATH))
+    return _npcTable
+
+
+class NpcSystem(object):
+    COLUMNS = (("_x", "float32"), ("_y", "float32"), ("_dx", "float32"), ("_dy", "float32"), ("_type", "uint16"), ("_bits", "uint16"), ("_flag", "uint16"), ("_event", "uint16"),
+               ("_state", "uint16"), ("_life", "int32"), ("_frame", "uint8"), ("_frameCount", "uint8"), ("_frameTimer", "float32"), ("_alive", "bool"))
+
+    def __init__(self, table, capacity = NPC.CAPACITY):
+        self._table = table
+        self._count = 0
+        self._free = []
+        self._touchEvents = False
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        for name, dtype in NpcSystem.COLUMNS:
+            column = np.zeros(capacity, dtype = dtype)
+            existing = getattr(self, name, None)
+            if existing is not None:
+                column[0:len(existing)] = existing
+            setattr(self, name, column)
+        self._capacity = capacity
+
+    def getCount(self):
+        return int(np.count_nonzero(self._alive[0:self._count]))
+
+    def spawn(self, npcType, x, y, flag = 0, event = 0, bits = 0, frameCount = 1):
+        if len(self._free) > 0:
+            index = self._free.pop()
+        else:
+            if self._count == self._capacity:
+                self.allocate(self._capacity * 2)
+            index = self._count
+            self._count += 1
+
+        self._x[index] = x
+        self._y[index] = y
+        self._dx[index] = 0
+        self._dy[index] = 0
+        self._type[index] = npcType
+        self._bits[index] = self._table.bits[npcType] | bits
+        self._flag[index] = flag
+        self._event[index] = event
+        self._state[index] = 0
+        self._life[index] = self._table.life[npcType]
+        self._frame[index] = 0
+        self._frameCount[index] = frameCount
+        self._frameTimer[index] = 0
+        self._alive[index] = True
+        self._touchEvents = self._touchEvents or self._bits[index] & NPC_FLAG.EVENT_WHEN_TOUCHED != 0
+        return index
+
+    def spawnStageEntities(self, entities, flags = None):
+        #An entity's flag decides whether it appears when the stage loads; flags outside the bitmap count as clear
+        flag = entities["flag"].astype(np.int32)
+        flagSet = np.zeros(len(entities), dtype = np.bool_)
+        if flags is not None:
+            inside = flag < len(flags) * 8
+            flagSet[inside] = (np.frombuffer(flags, dtype = np.uint8)[flag[inside] >> 3] >> (flag[inside] & 7)) & 1 == 1
+        bits = entities["bits"]
+        hidden = ((bits & NPC_FLAG.APPEAR_WHEN_FLAG_SET != 0) & ~flagSet) | ((bits & NPC_FLAG.HIDE_WHEN_FLAG_SET != 0) & flagSet)
+        entities = entities[(entities["type"] != 0) & ~hidden]
+        entities = entities[entities["type"] < self._table.count]
+        count = len(entities)
+        if count == 0:
+            return
+
+        if self._count + count > self._capacity:
+            capacity = self._capacity
+            while self._count + count > capacity:
+                capacity *= 2
+            self.allocate(capacity)
+
+        scale = STAGE.TILE_SIZE * GLOBAL.SPRITE_SCALE
+        types = entities["type"]
+        span = slice(self._count, self._count + count)
+        self._x[span] = entities["x"] * scale + scale // 2
+        self._y[span] = entities["y"] * scale + scale // 2
+        self._dx[span] = 0
+        self._dy[span] = 0
+        self._type[span] = types
+        self._bits[span] = self._table.bits[types] | entities["bits"]
+        self._flag[span] = entities["flag"]
+        self._event[span] = entities["event"]
+        self._state[span] = 0
+        self._life[span] = self._table.life[types]
+        self._frame[span] = 0
+        self._frameCount[span] = 1
+        self._frameTimer[span] = 0
+        self._alive[span] = True
+        self._touchEvents = self._touchEvents or bool((self._bits[span] & NPC_FLAG.EVENT_WHEN_TOUCHED).any())
+        self._count += count
+
+    def rebuildFreeList(self):
+        self._free = np.flatnonzero(~self._alive[0:self._count])[::-1].tolist()
+
+    def findTouchedEvent(self, left, top, right, bottom):
+        if not self._touchEvents:
+            return 0
+
+        count = self._count
+        hitBoxes = self._table.hitBoxes[self._type[0:count]].astype(np.float32) * GLOBAL.SPRITE_SCALE
+        x = self._x[0:count]
+        y = self._y[0:count]
+        touched = self._alive[0:count] & (self._bits[0:count] & NPC_FLAG.EVENT_WHEN_TOUCHED != 0) & \
+            (x - hitBoxes[:, 0] < right) & (x + hitBoxes[:, 2] > left) & (y - hitBoxes[:, 1] < bottom) & (y + hitBoxes[:, 3] > top)
+        indices = np.flatnonzero(touched)
+        return int(self._event[indices[0]]) if len(indices) > 0 else 0
+
+    def kill(self, index):
+        if self._alive[index]:
+            self._alive[index] = False
+            self._dx[index] = 0
+            self._dy[index] = 0
+            self._free.append(index)
+
+    def update(self, elapsedTime, collision = None, tileSize = STAGE.TILE_SIZE * GLOBAL.SPRITE_SCALE):
+        count = self._count
+        if count == 0:
+            return
+
+        alive = self._alive[0:count]
+        x = self._x[0:count]
+        y = self._y[0:count]
+        dx = self._dx[0:count]
+        dy = self._dy[0:count]
+
+        falling = alive & (self._bits[0:count] & NPC_FLAG.IGNORE_SOLIDITY == 0)
+        dy[falling] = np.minimum(dy[falling] + NPC.GRAVITY * elapsedTime, NPC.GRAVITY_CAP)
+        x += dx * elapsedTime
+        y += dy * elapsedTime
+
+        if collision is not None:
+            #Land falling entities on the solid tile under the bottom of their hit box
+            bottom = self._table.hitBoxes[self._type[0:count], 3].astype(np.float32) * GLOBAL.SPRITE_SCALE
+            rows = ((y + bottom) // tileSize).astype(np.intp)
+            columns = (x // tileSize).astype(np.intp)
+            inside = falling & (dy > 0) & (rows >= 0) & (rows < collision.shape[0]) & (columns >= 0) & (columns < collision.shape[1])
+            landed = np.zeros(count, dtype = np.bool_)
+            landed[inside] = collision[rows[inside], columns[inside]] == TILE_CLASS.SOLID
+            y[landed] = rows[landed] * tileSize - bottom[landed]
+            dy[landed] = 0
+
+        timers = self._frameTimer[0:count]
+        timers[alive] += elapsedTime
+        advance = timers >= NPC.FRAME_TIME
+        if advance.any():
+            frames = self._frame[0:count]
+            frames[advance] = (frames[advance] + 1) % np.maximum(self._frameCount[0:count][advance], 1)
+            timers[advance] -= NPC.FRAME_TIME
+
+
+
+def decodeTsc(data):
+    data = bytearray(data)
+    if len(data) == 0:
+        return bytes(data)
+
+    half = len(data) // 2
+    key = data[half] if data[half] != 0 else 7
+    keyByte = data[half]
+    data = data.translate(bytes((i - key) & 0xFF for i in range(256)))
+    data[half] = keyByte
+    return bytes(data)
+
+def tscNumber(text, offset):
+    return (text[offset] - 48) * 1000 + (text[offset + 1] - 48) * 100 + (text[offset + 2] - 48) * 10 + (text[offset + 3] - 48)
+
+
+class CompiledScript(object):
+    def __init__(self):
+        self.code = array.array("i")
+        self.events = {}
+        self.strings = []
+
+    def write(self, cachePath, mtime):
+        chunks = [TSC.HEADER.pack(TSC.MAGIC, TSC.VERSION, mtime, len(self.code), len(self.events), len(self.strings))]
+        for event, offset in self.events.items():
+            chunks.append(struct.pack("<iI", event, offset))
+        chunks.append(self.code.tobytes())
+        for string in self.strings:
+            chunks.append(struct.pack("<I", len(string)) + string)
+
+        os.makedirs(os.path.dirname(cachePath), exist_ok = True)
+        tempPath = "%s.%d.tmp" % (cachePath, os.getpid())
+        with open(tempPath, "wb") as f:
+            f.write(b"".join(chunks))
+        os.replace(tempPath, cachePath)
+
+
+def compileTsc(text):
+    script = CompiledScript()
+    code = script.code
+    length = len(text)
+    i = 0
+    textStart = -1
+    while i < length:
+        c = text[i]
+        if c == 0x23 and (i == 0 or text[i - 1] == 0x0A) and i + 5 <= length:     # '#' at the start of a line
+            if textStart != -1:
+                _emitText(script, text[textStart:i])
+                textStart = -1
+            script.events.setdefault(tscNumber(text, i + 1), len(code))
+            i += 5
+            while i < length and text[i] in b"\r\n":
+                i += 1
+
+        elif c == 0x3C and i + 4 <= length:    # '<'
+            if textStart != -1:
+                _emitText(script, text[textStart:i])
+                textStart = -1
+            name = text[i + 1:i + 4].decode("ascii", "replace")
+            opcode = TSC_OPCODES.get(name)
+            if opcode is None:
+                raise ValueError("Unknown TSC command <%s at byte %d" % (name, i))
+            code.append(opcode)
+            for k in range(0, TSC_ARGUMENT_COUNTS[name]):
+                code.append(tscNumber(text, i + 4 + k * 5) if i + 8 + k * 5 <= length else 0)
+            i += 4 + TSC_ARGUMENT_COUNTS[name] * 5
+            if TSC_ARGUMENT_COUNTS[name] > 0:
+                i -= 1
+
+        else:
+            if textStart == -1:
+                textStart = i
+            i += 1
+
+    if textStart != -1:
+        _emitText(script, text[textStart:])
+    return script
+
+def _emitText(script, text):
+    if text.strip(b"\r\n\t ") == b"":
+        return
+    script.code.append(TSC_TEXT)
+    script.code.append(len(script.strings))
+    script.strings.append(text)
+
+def readCompiledScript(cachePath, mtime):
+    try:
+        with open(cachePath, "rb") as f:
+            data = f.read()
+        magic, version, sourceTime, codeLength, numEvents, numStrings = TSC.HEADER.unpack_from(data, 0)
+        if magic != TSC.MAGIC or version != TSC.VERSION or sourceTime != mtime:
+            return None
+
+        script = CompiledScript()
+        offset = TSC.HEADER.size
+        for i in range(0, numEvents):
+            event, codeOffset = struct.unpack_from("<iI", data, offset)
+            script.events[event] = codeOffset
+            offset += 8
+        script.code.frombytes(data[offset:offset + codeLength * 4])
+        offset += codeLength * 4
+        for i in range(0, numStrings):
+            stringLength, = struct.unpack_from("<I", data, offset)
+            script.strings.append(data[offset + 4:offset + 4 + stringLength])
+            offset += 4 + stringLength
+        if offset != len(data) or len(script.code) != codeLength:
+            return None
+        return script
+
+    except (OSError, struct.error):
+        return None
+
+
+class ScriptCache(object):
+    def __init__(self, directory = TSC.CACHE_DIRECTORY):
+        self._directory = directory
+        self._scripts = {}
+        self._lock = threading.Lock()
+
+    def load(self, scriptPath):
+        sourcePath = TSC.DIRECTORY + scriptPath
+        mtime = assetVersion(sourcePath)
+        with self._lock:
+            entry = self._scripts.get(scriptPath)
+            if entry is not None and entry[0] == mtime:
+                return entry[1]
+
+            cachePath = self.getCachePath(scriptPath)
+            script = readCompiledScript(cachePath, mtime)
+            if script is None:
+                script = compileTsc(decodeTsc(readAsset(sourcePath)))
                 try:
-                    if len(doc.map.layer[k].data) == 1:
-                      pass
-
-                    else:   #else multiple tile tags
-                        tileCounter = 0
-                        for i in range(0, len(doc.map.layer[k].data)):
-                            if doc.map.layer[k].data.tile[i]["gid"] == 0:
-                                tileCounter += 1
-                                if i < (len(doc.map.layer[k].data)):
-                                    continue
-                                else:
-                                    break
-                            try:
-                                gid = int(doc.map.layer[k].data.tile[i]["gid"])
-                            except TypeError:
-                                gid = 0
-                            
-                            if gid == 0:
-                                tileCounter += 1
-                                if i < (len(doc.map.layer[k].data)):
-                                    continue
-                                else:
-                                    break
-
-                            tls = Tileset()
-                            for i in range(0, len(self._tilesets)):
-                                if self._tilesets[i].FirstGid <= gid:
-                                    tls = self._tilesets[i]
-                                    break
-                            
-                            if tls.FirstGid == -1:
-                                tileCounter += 1
-                                if i < (len(doc.map.layer[k].data)):
-                                    continue
-                                else:
-                                    break
-
-                            xx = 0
-                            yy = 0
-                            xx = tileCounter % width
-                            xx *= tileWidth
-                            yy += tileHeight * (tileCounter // width)#
-                            finalTilePosition = Vector2(xx, yy)
-
-                            tilesetWidth, tilesetHeight = 256, 80   #0, 0
-                            SDL_QueryTexture(tls.Texture, None, None, byref(c_int(tilesetWidth)), byref(c_int(tilesetHeight)))
-                            tsxx = gid % (tilesetWidth // tileWidth) - 1
-                            tsxx *= tileWidth
-                            tsyy = 0
-                            amt = int((gid // (tilesetWidth // tileWidth)))#
-                            tsyy = tileHeight * amt
-                            finalTilesetPosition = Vector2(tsxx, tsyy)
-
-                            tile = Tile(tls.Texture, Vector2(tileWidth, tileHeight), finalTilesetPosition, finalTilePosition)
-                            self._tileList.append(tile)
-                            tileCounter += 1
-
-                except (AttributeError, IndexError):
-                    traceback.print_exc()
-                    #print(e)
+                    script.write(cachePath, mtime)
+                except OSError:
                     pass
 
+            self._scripts[scriptPath] = (mtime, script)
+            return script
+
+    def getCachePath(self, scriptPath):
+        return self._directory + scriptPath + ".tsb"
+
+    def isCached(self, scriptPath):
+        sourcePath = TSC.DIRECTORY + scriptPath
+        return not assetExists(sourcePath) or readCompiledScript(self.getCachePath(scriptPath), assetVersion(sourcePath)) is not None
+
+scriptCache = ScriptCache()
+
+def loadStageScripts(stageName):
+    if not assetExists(TSC.DIRECTORY + "Stage/" + stageName + ".tsc"):
+        return []
+    return [scriptCache.load("Head.tsc"), scriptCache.load("Stage/" + stageName + ".tsc")]
+
+
+class ScriptRunner(object):
+    def __init__(self, scripts, flags = None):
+        self._scripts = scripts
+        self._script = None
+        self._pc = 0
+        self._wait = 0
+        self._waitingForKey = False
+        self._inputLocked = False
+        self._flags = flags if flags is not None else bytearray(TSC.FLAG_COUNT // 8)
+        self._message = []
+        self._messageOpen = False
+        self.onTransfer = None
+        self._handlers = {
+            TSC_OPCODES["END"]: self.end,
+            TSC_OPCODES["ESC"]: self.end,
+            TSC_OPCODES["INI"]: self.end,
+            TSC_OPCODES["LDP"]: self.end,
+            TSC_OPCODES["EVE"]: self.jump,
+            TSC_OPCODES["WAI"]: self.waitFrames,
+            TSC_OPCODES["NOD"]: self.waitForKey,
+            TSC_OPCODES["MSG"]: self.openMessage,
+            TSC_OPCODES["MS2"]: self.openMessage,
+            TSC_OPCODES["MS3"]: self.openMessage,
+            TSC_OPCODES["CLR"]: self.clearMessage,
+            TSC_OPCODES["CLO"]: self.closeMessage,
+            TSC_OPCODES["KEY"]: self.lockInput,
+            TSC_OPCODES["PRI"]: self.lockInput,
+            TSC_OPCODES["FRE"]: self.unlockInput,
+            TSC_OPCODES["FL+"]: self.setFlag,
+            TSC_OPCODES["FL-"]: self.clearFlag,
+            TSC_OPCODES["FLJ"]: self.jumpIfFlag,
+            TSC_OPCODES["TRA"]: self.transfer,
+        }
+
+    def startEvent(self, event):
+        for script in self._scripts:
+            offset = script.events.get(event)
+            if offset is not None:
+                self._script = script
+                self._pc = offset
+                self._wait = 0
+                self._waitingForKey = False
+                return True
+        return False
+
+    def isRunning(self):
+        return self._script is not None
+
+    def isInputLocked(self):
+        return self._script is not None and self._inputLocked
+
+    def isWaitingForKey(self):
+        return self._waitingForKey
+
+    def resume(self):
+        self._waitingForKey = False
+
+    def getMessage(self):
+        return "".join(self._message)
+
+    def getFlags(self):
+        return self._flags
+
+    def getFlag(self, flag):
+        return 0 <= flag < TSC.FLAG_COUNT and (self._flags[flag // 8] >> (flag % 8)) & 1 == 1
+
+    def update(self):
+        if self._wait > 0:
+            self._wait -= 1
+            return
+        if self._waitingForKey:
+            return
+
+        for i in range(0, TSC.OPCODES_PER_UPDATE):
+            script = self._script
+            if script is None:
+                return
+
+            code = script.code
+            #An event may run off the end of its script without an <END
+            if self._pc >= len(code):
+                self.end(None)
+                return
+            opcode = code[self._pc]
+            if opcode == TSC_TEXT:
+                if self._messageOpen:
+                    self._message.append(script.strings[code[self._pc + 1]].decode(TSC.ENCODING, "replace"))
+                self._pc += 2
+                continue
+
+            argumentCount = TSC_ARGUMENT_COUNTS[TSC_NAMES[opcode]]
+            arguments = code[self._pc + 1:self._pc + 1 + argumentCount]
+            self._pc += 1 + argumentCount
+            handler = self._handlers.get(opcode)
+            if handler is not None and handler(arguments) == False:
+                return
+
+    def end(self, arguments):
+        self._script = None
+        self._inputLocked = False
+        self._messageOpen = False
+        return False
+
+    def jump(self, arguments):
+        if not self.startEvent(arguments[0]):
+            return self.end(arguments)
+
+    def waitFrames(self, arguments):
+        self._wait = arguments[0]
+        return False
+
+    def waitForKey(self, arguments):
+        self._waitingForKey = True
+        return False
+
+    def openMessage(self, arguments):
+        self._messageOpen = True
+        self._message = []
+
+    def clearMessage(self, arguments):
+        self._message = []
+
+    def closeMessage(self, arguments):
+        self._messageOpen = False
+        self._message = []
+
+    def lockInput(self, arguments):
+        self._inputLocked = True
+
+    def unlockInput(self, arguments):
+        self._inputLocked = False
+
+    def setFlag(self, arguments):
+        if 0 <= arguments[0] < TSC.FLAG_COUNT:
+            self._flags[arguments[0] // 8] |= 1 << (arguments[0] % 8)
+
+    def clearFlag(self, arguments):
+        if 0 <= arguments[0] < TSC.FLAG_COUNT:
+            self._flags[arguments[0] // 8] &= ~(1 << (arguments[0] % 8)) & 0xFF
+
+    def jumpIfFlag(self, arguments):
+        if self.getFlag(arguments[0]):
+            return self.jump(arguments[1:])
+
+    def transfer(self, arguments):
+        self.end(arguments)
+        if self.onTransfer is not None:
+            self.onTransfer(arguments[0], arguments[1], arguments[2], arguments[3])
+        return False
+
+
+def prepareLevel(mapName):
+    return createLevel(mapName, Vector2(100, 100))
+
+def createLevel(mapName, spawnPoint, graphics = None, data = None):
+    if isStage(mapName):
+        return StageLevel(mapName, spawnPoint, graphics, data)
+    return Level(mapName, spawnPoint, graphics, data)
+
+
+class LevelLoader(object):
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "LevelLoader")
+        self._futures = {}
+        self._requested = None
+
+    def prefetch(self, mapName):
+        if mapName not in self._futures:
+            self._futures[mapName] = self._executor.submit(prepareLevel, mapName)
 
-        except (AttributeError, IndexError):
+    def request(self, mapName):
+        self.prefetch(mapName)
+        self._requested = mapName
+
+    def isLoading(self):
+        return self._requested is not None
+
+    def poll(self):
+        if self._requested is None or not self._futures[self._requested].done():
+            return None, None
+
+        mapName = self._requested
+        self._requested = None
+        future = self._futures.pop(mapName)
+        try:
+            return mapName, future.result()
+        except Exception:
             traceback.print_exc()
-            #print(e)
-            pass
+            return None, None
 
-        #Load Collisions
-        #try:
-        for i in range(0, len(doc.map.objectgroup)):
-            name = doc.map.objectgroup[i]["name"]
-            if name == "collisions":
-                for j in range(0, len(doc.map.objectgroup[i])):
-                    x, y, width, height = 0, 0, 0, 0
-                    x = float(doc.map.objectgroup[i].object[j]["x"])
-                    y = float(doc.map.objectgroup[i].object[j]["y"])
-                    width = float(doc.map.objectgroup[i].object[j]["width"])
-                    height = float(doc.map.objectgroup[i].object[j]["height"])
-                    self._collisionRects.append(Rectangle(math.ceil(x) * GLOBAL.SPRITE_SCALE, math.ceil(y) * GLOBAL.SPRITE_SCALE, math.ceil(width) * GLOBAL.SPRITE_SCALE, math.ceil(height) * GLOBAL.SPRITE_SCALE))
-            if name == "slopes":
-                for j in range(0, len(doc.map.objectgroup[i])):
-                    points = []
-                    p1 = Vector2(math.ceil(float(doc.map.objectgroup[i].object[j]["x"])), math.ceil(float(doc.map.objectgroup[i].object[j]["y"])))
-                    pairs = []
-                    pointString = doc.map.objectgroup[i].object[j].polyline["points"]
-                    pairs.append(pointString.split(' '))
-
-                    for k in range(0, len(pairs[0])):
-                        ps = []
-                        ps.append(pairs[0][k].split(","))
-                        points.append(Vector2(int(math.ceil(float(ps[0][0]))), int(math.ceil(float(ps[0][1])))))
-                    
-                    for k in range(0, len(points), 2):
-                        if k < 2:
-                            self._slopes.append(Slope(Vector2((p1.x + points[k].x) * GLOBAL.SPRITE_SCALE, (p1.y + points[k].y) * GLOBAL.SPRITE_SCALE), Vector2((p1.x + points[k + 1].x) * GLOBAL.SPRITE_SCALE, (p1.y + points[k + 1].y) * GLOBAL.SPRITE_SCALE)))
-                        else:
-                            self._slopes.append(Slope(Vector2((p1.x + points[k - 1].x) * GLOBAL.SPRITE_SCALE, (p1.y + points[k - 1].y) * GLOBAL.SPRITE_SCALE), Vector2((p1.x + points[k].x) * GLOBAL.SPRITE_SCALE, (p1.y + points[k].y) * GLOBAL.SPRITE_SCALE)))
-
-            if name == "spawn points":
-                if len(doc.map.objectgroup[i]) == 1:
-                    x = float(doc.map.objectgroup[i].object["x"])
-                    y = float(doc.map.objectgroup[i].object["y"])
-                    name = doc.map.objectgroup[i].object["name"]
-                    if name == "player":
-                        self._spawnPoint = Vector2(math.ceil(x) * GLOBAL.SPRITE_SCALE, math.ceil(y) * GLOBAL.SPRITE_SCALE)
-                else: 
-                    for j in range(0, len(doc.map.objectgroup[i])):
-                        x = float(doc.map.objectgroup[i].object[j]["x"])
-                        y = float(doc.map.objectgroup[i].object[j]["y"])
-                        name = doc.map.objectgroup[i].object[j]["name"]
-                        if name == "player":
-                            self._spawnPoint = Vector2(math.ceil(x) * GLOBAL.SPRITE_SCALE, math.ceil(y) * GLOBAL.SPRITE_SCALE)
+    def shutdown(self):
+        self._executor.shutdown(wait = False, cancel_futures = True)
+
+
+class Background(object):
+    def __init__(self, graphics, filePath, mode):
+        self._filePath = filePath
+        self._mode = mode
+        self._scroll = 0.0
+        self._layers = []
+        for sourceY, height, cameraX, cameraY, autoX, repeatY in BACKGROUND_LAYERS.get(mode, ()):
+            texture, width, tiledHeight = graphics.acquireBackground(filePath, sourceY, height, repeatY)
+            self._layers.append((texture, sourceY, height, width, tiledHeight, cameraX, cameraY, autoX, repeatY))
+
+    def update(self, elapsedTime):
+        self._scroll += elapsedTime * BACKGROUND.SCROLL_SPEED
+
+    def draw(self, graphics, camera):
+        scale = GLOBAL.SPRITE_SCALE
+        for texture, sourceY, height, width, tiledHeight, cameraX, cameraY, autoX, repeatY in self._layers:
+            if width == 0:
+                continue
+            #Each strip is pre-tiled to at least the screen size, so two copies per axis cover any offset
+            w, h = width * scale, tiledHeight * scale
+            x = -(int(camera.getLeft() * cameraX + self._scroll * autoX * scale) % w)
+            y = -(int(camera.getTop() * cameraY) % h) if repeatY else sourceY * scale
+            rows = (y, y + h) if repeatY and y + h < GLOBAL.SCREEN_HEIGHT else (y,)
+            columns = (x, x + w) if x + w < GLOBAL.SCREEN_WIDTH else (x,)
+            for drawY in rows:
+                for drawX in columns:
+                    graphics.drawQuad(texture, 0, 0, width, tiledHeight, drawX, drawY, w, h)
+
+    def unload(self, graphics):
+        for texture, sourceY, height, width, tiledHeight, cameraX, cameraY, autoX, repeatY in self._layers:
+            graphics.releaseBackground(self._filePath, sourceY, height, repeatY)
+        self._layers = []
 
 
-    
 class Tile(object):
+    __slots__ = ("_tileset", "_size", "_tilesetPostion", "_position")
+
     def __init__(self, tileset, size, tilesetPosition, position):
         self._tileset = tileset
         self._size = size
@@ -552,32 +2544,280 @@ class Tile(object):
     def update(self, elapsedTime):
         pass
 
-    def draw(self, graphics):
-        destRect = SDL_Rect(int(self._position.x), int(self._position.y), self._size.x * GLOBAL.SPRITE_SCALE, self._size.y * GLOBAL.SPRITE_SCALE)
-        sourceRect = SDL_Rect(self._tilesetPostion.x, self._tilesetPostion.y, self._size.x, self._size.y)
+    def draw(self, graphics, offsetX = 0, offsetY = 0):
+        graphics.drawQuad(self._tileset.Texture, self._tilesetPostion.x, self._tilesetPostion.y, self._size.x, self._size.y,
+            int(self._position.x) + offsetX, int(self._position.y) + offsetY, self._size.x * GLOBAL.SPRITE_SCALE, self._size.y * GLOBAL.SPRITE_SCALE)
+
+
+class FrameProfiler(object):
+    def __init__(self, history = PROFILE.HISTORY, tracePath = None):
+        self._samples = np.zeros((history, len(PROFILE_PHASES) + 1), dtype = np.float64)
+        self._current = np.zeros(len(PROFILE_PHASES), dtype = np.float64)
+        self._frames = 0
+        self._frameStart = 0.0
+        self._phaseStart = 0.0
+        self._origin = time.perf_counter()
+        self._trace = [] if tracePath is not None else None
+        self._tracePath = tracePath
+        self._traceFile = None
+
+    def beginFrame(self):
+        self._current[:] = 0
+        self._frameStart = time.perf_counter()
+
+    def begin(self, phase):
+        self._phaseStart = time.perf_counter()
+
+    def end(self, phase):
+        now = time.perf_counter()
+        self._current[phase] += now - self._phaseStart
+        if self._trace is not None:
+            self._trace.append((phase, self._phaseStart, now - self._phaseStart))
+
+    def endFrame(self):
+        now = time.perf_counter()
+        row = self._samples[self._frames % len(self._samples)]
+        row[0:len(PROFILE_PHASES)] = self._current
+        row[len(PROFILE_PHASES)] = now - self._frameStart
+        if self._trace is not None:
+            self._trace.append((-1, self._frameStart, now - self._frameStart))
+            if len(self._trace) >= PROFILE.TRACE_FLUSH:
+                self.flushTrace()
+        self._frames += 1
+
+    def getLastFrame(self):
+        if self._frames == 0:
+            return self._samples[0]
+        return self._samples[(self._frames - 1) % len(self._samples)]
+
+    def getPercentiles(self, percentiles = (50, 95, 99)):
+        samples = self._samples[0:min(self._frames, len(self._samples))]
+        if len(samples) == 0:
+            return {}
+        values = np.percentile(samples, percentiles, axis = 0) * 1000
+        names = PROFILE_PHASES + ("frame",)
+        return {names[i]: values[:, i].tolist() for i in range(0, len(names))}
+
+    def report(self, percentiles = (50, 95, 99)):
+        lines = ["%-12s " % "ms" + " ".join("%7s" % ("p%d" % p) for p in percentiles)]
+        for name, values in self.getPercentiles(percentiles).items():
+            lines.append("%-12s " % name + " ".join("%7.3f" % value for value in values))
+        return "\n".join(lines)
+
+    def flushTrace(self):
+        #Stream buffered events to disk so a long session keeps at most PROFILE.TRACE_FLUSH of them in memory
+        if self._trace is None or len(self._trace) == 0:
+            return
+        if self._traceFile is None:
+            self._traceFile = open(self._tracePath, "w")
+            self._traceFile.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        else:
+            self._traceFile.write(",\n")
+        names = PROFILE_PHASES + ("frame",)
+        self._traceFile.write(",\n".join(json.dumps({"name": names[phase], "ph": "X", "pid": 0, "tid": 0 if phase == -1 else 1,
+            "ts": round((start - self._origin) * 1e6, 3), "dur": round(duration * 1e6, 3)}) for phase, start, duration in self._trace))
+        self._trace = []
+
+    def closeTrace(self):
+        if self._trace is None:
+            return
+        self.flushTrace()
+        if self._traceFile is None:
+            self._traceFile = open(self._tracePath, "w")
+            self._traceFile.write('{"displayTimeUnit": "ms", "traceEvents": [')
+        self._traceFile.write("\n]}\n")
+        self._traceFile.close()
+        self._traceFile = None
+        self._trace = None
+
+    def finish(self):
+        print(self.report())
+        self.closeTrace()
+
+    def drawOverlay(self, graphics):
+        #One stacked bar per phase for the last frame, PROFILE.OVERLAY_SCALE pixels per millisecond
+        x = 8
+        for phase in range(0, len(PROFILE_PHASES)):
+            width = int(self.getLastFrame()[phase] * 1000 * PROFILE.OVERLAY_SCALE)
+            if width > 0:
+                graphics.fillRect(x, 8, width, 8, PROFILE_COLORS[phase])
+                x += width
+        budget = int(1000 / FPS * PROFILE.OVERLAY_SCALE)
+        graphics.fillRect(8 + budget, 4, 2, 16, (255, 255, 255, 255))
+
+
+class NullProfiler(object):
+    def beginFrame(self):
+        pass
 
-        graphics.blitSurface(self._tileset, sourceRect, destRect)
+    def begin(self, phase):
+        pass
+
+    def end(self, phase):
+        pass
+
+    def endFrame(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def drawOverlay(self, graphics):
+        pass
+
+
+class FramePacer(object):
+    def __init__(self, fps):
+        self._frequency = SDL_GetPerformanceFrequency()
+        self._period = self._frequency // fps
+        self._deadline = SDL_GetPerformanceCounter() + self._period
+
+    def wait(self):
+        #Sleep most of the remaining time and spin the last SLEEP_MARGIN_MS, which SDL_Delay cannot hit reliably
+        now = SDL_GetPerformanceCounter()
+        remaining = (self._deadline - now) * 1000 // self._frequency
+        if remaining > LOOP.SLEEP_MARGIN_MS:
+            SDL_Delay(int(remaining - LOOP.SLEEP_MARGIN_MS))
+        while SDL_GetPerformanceCounter() < self._deadline:
+            pass
+
+        #Schedule from the previous deadline so pacing does not drift, unless a slow frame left us a whole period behind
+        self._deadline += self._period
+        now = SDL_GetPerformanceCounter()
+        if now > self._deadline:
+            self._deadline = now + self._period
+
+
+class SnapshotLayout(object):
+    def __init__(self, game):
+        npcs = game._level.getNpcs()
+        self._npcCapacity = npcs._capacity if npcs is not None else 0
+        self._systems = [system for system in (game._projectiles, game._carets, npcs) if system is not None]
+        self._columns = []  #system, column name, byte offset, length in elements
+        offset = SNAPSHOT.PLAYER.size + SNAPSHOT.WORLD.size
+        for system in self._systems:
+            for name, dtype in system.COLUMNS:
+                column = getattr(system, name)
+                self._columns.append((system, name, offset, len(column)))
+                offset += column.nbytes
+        self.size = offset
+
+    def isCurrent(self, game):
+        npcs = game._level.getNpcs()
+        return (npcs._capacity if npcs is not None else 0) == self._npcCapacity
+
+    def capture(self, game, row):
+        npcs = game._level.getNpcs()
+        SNAPSHOT.PLAYER.pack_into(row, 0, *game._player.getState())
+        SNAPSHOT.WORLD.pack_into(row, SNAPSHOT.PLAYER.size, game._background._scroll, npcs._count if npcs is not None else 0)
+        for system, name, offset, length in self._columns:
+            column = getattr(system, name)
+            row[offset:offset + column.nbytes] = column.view(np.uint8)
+
+    def restore(self, game, row):
+        game._player.setState(SNAPSHOT.PLAYER.unpack_from(row, 0))
+        scroll, npcCount = SNAPSHOT.WORLD.unpack_from(row, SNAPSHOT.PLAYER.size)
+        game._background._scroll = scroll
+        #Columns may have grown since this layout was taken; the older entries are still a prefix of them
+        for system, name, offset, length in self._columns:
+            column = getattr(system, name)[0:length].view(np.uint8)
+            column[:] = row[offset:offset + len(column)]
+        npcs = game._level.getNpcs()
+        if npcs is not None:
+            npcs._count = npcCount
+        for system in self._systems:
+            system.rebuildFreeList()
+
+
+class SnapshotRing(object):
+    def __init__(self, game, capacity = SNAPSHOT.HISTORY):
+        self._capacity = capacity
+        self._startLayout = SnapshotLayout(game)
+        self._start = np.zeros(self._startLayout.size, dtype = np.uint8)
+        self._startLayout.capture(game, self._start)
+        self.allocate(self._startLayout)
+
+    def allocate(self, layout):
+        self._layout = layout
+        self._data = np.zeros((self._capacity, layout.size), dtype = np.uint8)
+        self._head = 0  #slot the next snapshot goes in
+        self._count = 0
+
+    def getSize(self):
+        return self._layout.size
+
+    def getCount(self):
+        return self._count
+
+    def push(self, game):
+        if not self._layout.isCurrent(game):
+            self.allocate(SnapshotLayout(game))
+        self._layout.capture(game, self._data[self._head])
+        self._head = (self._head + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def rewind(self, game, steps = 1):
+        #The newest snapshot is the current state, so step back from the one before it
+        steps = min(steps, self._count - 1)
+        if steps <= 0:
+            return False
+        self._head = (self._head - steps) % self._capacity
+        self._count -= steps
+        self._layout.restore(game, self._data[(self._head - 1) % self._capacity])
+        return True
+
+    def restart(self, game):
+        self._startLayout.restore(game, self._start)
+        self._count = 0
 
 
 class Game(object):
     def __init__(self):
-        SDL_Init(SDL_INIT_EVERYTHING)
         self.gameLoop()
 
+    def resetState(self, graphics, profiler, recording = None, loader = None):
+        self._graphics = graphics
+        self._profiler = profiler
+        self._recording = recording
+        self._loader = loader
+        self._level = None
+        self._player = None
+        self._projectiles = None
+        self._carets = None
+        self._background = None
+        self._snapshots = None
+        self._script = None
+        self._flags = bytearray(TSC.FLAG_COUNT // 8)
+        self._entry = None
+
     def gameLoop(self):
         graphics = Graphics()
         input = Input()
         event = SDL_Event()
 
-        self._level = Level("Map 1", Vector2(100, 100), graphics)
-        self._player = Player(graphics, self._level._spawnPoint)
+        profiler = FrameProfiler(tracePath = PROFILE.TRACE_PATH) if PROFILE.ENABLED else NullProfiler()
+        #Recorded runs step a fixed timestep and load levels synchronously, so a replay sees the same frames
+        recording = InputRecording("Map 1") if REPLAY.RECORD_PATH is not None else None
+        self.resetState(graphics, profiler, recording, LevelLoader() if recording is None else None)
+        self.loadLevel("Map 1", graphics)
 
+        pacer = FramePacer(LOOP.RENDER_FPS) if LOOP.RENDER_FPS and not graphics.hasVSync() else None
+        step = 1000 / FPS
+        accumulator = 0
         LAST_UPDATE_TIME = SDL_GetTicks()
 
         while True:
             input.beginNewFrame()
+            self._profiler.beginFrame()
+            self._profiler.begin(PROFILE_PHASE.INPUT)
 
-            if (SDL_PollEvent(byref(event))):
+            if self._loader is not None:
+                mapName, level = self._loader.poll()
+                if level is not None:
+                    self.loadLevel(mapName, graphics, level)
+                    LAST_UPDATE_TIME = SDL_GetTicks()
+
+            while (SDL_PollEvent(byref(event)) != 0):
                 if (event.type == SDL_KEYDOWN):
                     if (event.key.repeat == 0):
                         input.keyDownEvent(event)
@@ -585,64 +2825,345 @@ class Game(object):
                 elif (event.type == SDL_KEYUP):
                     input.keyUpEvent(event)
 
+                elif (event.type == SDL_RENDER_TARGETS_RESET):
+                    self._level.bakeLayers(graphics)
+
                 elif (event.type == SDL_QUIT):
+                    self.shutdown()
                     return
 
             if (input.wasKeyPressed(SDL_SCANCODE_ESCAPE) == True):
+                self.shutdown()
                 return
 
-            elif (input.isKeyHeld(SDL_SCANCODE_LEFT) == True):
-                self._player.moveLeft()
+            if self._recording is not None:
+                self._recording.record(input.getKeyMask())
 
-            elif (input.isKeyHeld(SDL_SCANCODE_RIGHT) == True):
-                self._player.moveRight()
-
-            if (input.isKeyHeld(SDL_SCANCODE_Z) == True):
-                self._player.jump()
-
-            if (input.isKeyHeld(SDL_SCANCODE_1) == True):
-                self._level = Level("Map 1", Vector2(100, 100), graphics)
-                self._player = Player(graphics, self._level._spawnPoint)
-                LAST_UPDATE_TIME = SDL_GetTicks()
-                continue
-            
-            if (input.isKeyHeld(SDL_SCANCODE_2) == True):
-                self._level = Level("Map 2", Vector2(100, 100), graphics)
-                self._player = Player(graphics, self._level._spawnPoint)
+            if self.handleInput(input, graphics):
                 LAST_UPDATE_TIME = SDL_GetTicks()
+                self._profiler.end(PROFILE_PHASE.INPUT)
+                self._profiler.endFrame()
                 continue
-
-            if (not input.isKeyHeld(SDL_SCANCODE_LEFT) and not input.isKeyHeld(SDL_SCANCODE_RIGHT)):
-                self._player.stopMoving()
+            rewinding = self._snapshots is not None and input.isKeyHeld(SNAPSHOT.REWIND_KEY)
+            if self._snapshots is not None and input.wasKeyPressed(SNAPSHOT.RESTART_KEY):
+                self._snapshots.restart(self)
+            self._profiler.end(PROFILE_PHASE.INPUT)
 
             CURRENT_TIME_MS = SDL_GetTicks()
             ELAPSED_TIME_MS = CURRENT_TIME_MS - LAST_UPDATE_TIME
-            self.update(min([ELAPSED_TIME_MS, MAX_FRAME_TIME]))
+            alpha = 1.0
+            if rewinding:
+                self._snapshots.rewind(self)
+            elif self._recording is not None:
+                self.update(self._recording.frameTime)
+            elif LOOP.FIXED_UPDATE:
+                accumulator += min([ELAPSED_TIME_MS, MAX_FRAME_TIME])
+                while accumulator >= step:
+                    self.update(step)
+                    accumulator -= step
+                alpha = accumulator / step
+            else:
+                self.update(min([ELAPSED_TIME_MS, MAX_FRAME_TIME]))
+            if self._snapshots is not None and not rewinding:
+                self._snapshots.push(self)
             LAST_UPDATE_TIME = CURRENT_TIME_MS
 
-            self.draw(graphics)
+            self.draw(graphics, alpha)
+            self._profiler.endFrame()
+            if STARTUP.FIRST_FRAME_ONLY:
+                print("first frame %.3f ms" % ((time.perf_counter() - STARTUP.STARTED) * 1000))
+                self.shutdown()
+                return
+            if pacer is not None:
+                pacer.wait()
+
+    def shutdown(self):
+        if self._loader is not None:
+            self._loader.shutdown()
+        if self._recording is not None:
+            self._recording.finish(self._player)
+            self._recording.write(REPLAY.RECORD_PATH)
+        self._profiler.finish()
+
+    def handleInput(self, input, graphics):
+        if self._script is not None and self._script.isInputLocked():
+            if self._script.isWaitingForKey() and (input.wasKeyPressed(SDL_SCANCODE_Z) or input.wasKeyPressed(SDL_SCANCODE_X)):
+                self._script.resume()
+            self._player.stopMoving()
+            return False
+
+        if (input.isKeyHeld(SDL_SCANCODE_LEFT) == True):
+            self._player.moveLeft()
 
-    def draw(self, graphics):
-        graphics.clear()
+        elif (input.isKeyHeld(SDL_SCANCODE_RIGHT) == True):
+            self._player.moveRight()
 
-        self._level.draw(graphics)
-        self._player.draw(graphics)
+        if (input.isKeyHeld(SDL_SCANCODE_Z) == True):
+            self._player.jump()
 
+        if (input.isKeyHeld(SDL_SCANCODE_X) == True):
+            if (input.isKeyHeld(SDL_SCANCODE_UP) == True):
+                aim = Direction.UP
+            elif (input.isKeyHeld(SDL_SCANCODE_DOWN) == True and not self._player._grounded):
+                aim = Direction.DOWN
+            else:
+                aim = self._player._facing
+            self._player.shoot(self._projectiles, self._carets, aim)
+
+        for key, mapName in LEVEL_HOTKEYS.items():
+            if (input.wasKeyPressed(key) == True):
+                if self.requestLevel(mapName, graphics):
+                    return True
+
+        if (not input.isKeyHeld(SDL_SCANCODE_LEFT) and not input.isKeyHeld(SDL_SCANCODE_RIGHT)):
+            self._player.stopMoving()
+
+        return False
+
+    def requestLevel(self, mapName, graphics):
+        if self._loader is None:
+            self.loadLevel(mapName, graphics)
+            return True
+
+        self._loader.request(mapName)
+        return False
+
+    def transferLevel(self, stage, event, x, y):
+        #<TRA moves to another stage, places the player on tile (x, y) and runs event there
+        if 0 <= stage < len(STAGE_TABLE):
+            self._entry = (STAGE_TABLE[stage][0], event, x, y)
+            self.requestLevel(self._entry[0], self._graphics)
+
+    def prefetchLevel(self, mapName):
+        if self._loader is not None:
+            self._loader.prefetch(mapName)
+
+    def loadLevel(self, mapName, graphics, level = None):
+        if self._level is not None:
+            self._level.unload(graphics)
+        if self._player is not None:
+            self._player.unload(graphics)
+        if self._background is not None:
+            self._background.unload(graphics)
+        if level is None:
+            self._level = createLevel(mapName, Vector2(100, 100), graphics)
+        else:
+            self._level = level
+            self._level.createTextures(graphics)
+        self._level.spawnEntities(self._flags)
+        entry = self._entry if self._entry is not None and self._entry[0] == mapName else None
+        self._entry = None
+        if entry is not None:
+            scale = STAGE.TILE_SIZE * GLOBAL.SPRITE_SCALE
+            self._player = Player(graphics, Vector2(entry[2] * scale, entry[3] * scale))
+        else:
+            self._player = Player(graphics, self._level._spawnPoint)
+        self._background = Background(graphics, *self._level.getBackground())
+        if self._projectiles is None:
+            self._projectiles = ProjectilePool(graphics)
+            self._carets = CaretPool(graphics)
+        self._projectiles.clear()
+        self._carets.clear()
+        self._script = None
+        if len(self._level.getScripts()) > 0:
+            self._script = ScriptRunner(self._level.getScripts(), self._flags)
+            self._script.onTransfer = self.transferLevel
+            if entry is not None:
+                self._script.startEvent(entry[1])
+        self._camera = Camera()
+        self._camera.follow(self._player._boundingBox, self._level.getPixelWidth(), self._level.getPixelHeight())
+        #Rewinding would desynchronise a recording from its input, so recorded runs keep no history
+        self._snapshots = SnapshotRing(self) if SNAPSHOT.HISTORY > 0 and self._recording is None else None
+
+        for adjacentMap in LEVEL_HOTKEYS.values():
+            if adjacentMap != mapName:
+                self.prefetchLevel(adjacentMap)
+
+    def draw(self, graphics, alpha = 1.0):
+        profiler = self._profiler
+        graphics.clear()
+
+        profiler.begin(PROFILE_PHASE.LEVEL_DRAW)
+        if alpha < 1.0:
+            x, y = self._player.interpolate(alpha)
+            box = self._player._boundingBox
+            self._camera.centerOn(x + box._width // 2, y + box._height // 2, self._level.getPixelWidth(), self._level.getPixelHeight())
+        else:
+            self._camera.follow(self._player._boundingBox, self._level.getPixelWidth(), self._level.getPixelHeight())
+        self._background.draw(graphics, self._camera)
+        self._level.draw(graphics, self._camera)
+        profiler.end(PROFILE_PHASE.LEVEL_DRAW)
+
+        profiler.begin(PROFILE_PHASE.SPRITE_DRAW)
+        self._player.draw(graphics, self._camera, alpha)
+        self._projectiles.draw(graphics, self._camera)
+        self._carets.draw(graphics, self._camera)
+        profiler.end(PROFILE_PHASE.SPRITE_DRAW)
+
+        profiler.begin(PROFILE_PHASE.PRESENT)
+        if PROFILE.OVERLAY:
+            profiler.drawOverlay(graphics)
         graphics.flip()
+        profiler.end(PROFILE_PHASE.PRESENT)
 
     def update(self, elapsedTime):
+        profiler = self._profiler
+        profiler.begin(PROFILE_PHASE.UPDATE)
+        if self._script is not None:
+            if not self._script.isRunning():
+                box = self._player._boundingBox
+                event = self._level.getNpcs().findTouchedEvent(box.getLeft(), box.getTop(), box.getRight(), box.getBottom())
+                if event != 0:
+                    self._script.startEvent(event)
+            self._script.update()
         self._player.update(elapsedTime)
         self._level.update(elapsedTime)
+        self._background.update(elapsedTime)
+        self._projectiles.update(elapsedTime, self._level, self._carets)
+        self._carets.update(elapsedTime)
+        profiler.end(PROFILE_PHASE.UPDATE)
+
+        if COLLISION.TILE_GRID and self._level.usesTileGrid():
+            tileSize = self._level._tileSize.x * GLOBAL.SPRITE_SCALE
+            profiler.begin(PROFILE_PHASE.BROADPHASE)
+            solids, slopes = self._level.checkTileGridCollisions(self._player._boundingBox)
+            profiler.end(PROFILE_PHASE.BROADPHASE)
+            profiler.begin(PROFILE_PHASE.NARROWPHASE)
+            if (len(solids) > 0):
+                self._player.handleTileGridCollisions(solids, tileSize)
+            if (len(slopes) > 0):
+                self._player.handleTileGridSlopes(slopes, tileSize)
+            profiler.end(PROFILE_PHASE.NARROWPHASE)
+            return
 
         others = []
+        profiler.begin(PROFILE_PHASE.BROADPHASE)
         others = self._level.checkTileCollisions(self._player._boundingBox)
+        profiler.end(PROFILE_PHASE.BROADPHASE)
+        profiler.begin(PROFILE_PHASE.NARROWPHASE)
         if (len(others) > 0):
             self._player.handleTileCollisions(others)
+        profiler.end(PROFILE_PHASE.NARROWPHASE)
 
         otherSlopes = []
+        profiler.begin(PROFILE_PHASE.BROADPHASE)
         otherSlopes = self._level.checkSlopeCollisions(self._player._boundingBox)
+        profiler.end(PROFILE_PHASE.BROADPHASE)
+        profiler.begin(PROFILE_PHASE.NARROWPHASE)
         if (len(otherSlopes) > 0):
             self._player.handleSlopeCollisions(otherSlopes)
+        profiler.end(PROFILE_PHASE.NARROWPHASE)
+
+
+class HeadlessGraphics(object):
+    def __init__(self):
+        self._renderer = None
+
+    def loadImage(self, filePath):
+        return None
+
+    def acquireTexture(self, filePath):
+        return POINTER(SDL_Texture)()
+
+    def releaseTexture(self, filePath):
+        pass
+
+    def acquireSheet(self, filePath):
+        return POINTER(SDL_Texture)(), 0, 0
+
+    def releaseSheet(self, filePath):
+        pass
+
+    def acquireBackground(self, filePath, sourceY, height, repeatY):
+        return None, 0, 0
+
+    def releaseBackground(self, filePath, sourceY, height, repeatY):
+        pass
+
+    def blitSurface(self, texture, sourceRectangle, destinationRectangle):
+        pass
+
+    def drawQuad(self, texture, sourceX, sourceY, sourceWidth, sourceHeight, x, y, width, height):
+        pass
+
+    def flushBatch(self):
+        pass
+
+    def flip(self):
+        pass
+
+    def fillRect(self, x, y, width, height, color):
+        pass
+
+    def clear(self):
+        pass
+
+
+class HeadlessGame(Game):
+    def __init__(self, mapName = "Map 1", profiler = None):
+        self.resetState(HeadlessGraphics(), profiler if profiler is not None else NullProfiler())
+        self._input = Input()
+        self._frame = 0
+        self.loadLevel(mapName, self._graphics)
+
+    def step(self, keys, frameTime = 1000 / FPS):
+        self._profiler.beginFrame()
+        self._profiler.begin(PROFILE_PHASE.INPUT)
+        self._input.beginNewFrame()
+        if keys.__class__ is int:
+            self._input.setKeyMask(keys)
+        else:
+            self._input.setKeys(keys)
+        if self._recording is not None:
+            self._recording.record(self._input.getKeyMask())
+        #A synchronous level switch skips the frame's update, as it does in gameLoop
+        if self.handleInput(self._input, self._graphics):
+            self._profiler.end(PROFILE_PHASE.INPUT)
+            self._profiler.endFrame()
+            self._frame += 1
+            return
+        self._profiler.end(PROFILE_PHASE.INPUT)
+        self.update(frameTime)
+        self._profiler.endFrame()
+        self._frame += 1
+
+    def run(self, script, frames):
+        for keys in expandInputScript(script, frames):
+            self.step(keys)
+
+    def replay(self, recording):
+        start = time.perf_counter()
+        for mask in recording.masks:
+            self.step(mask, recording.frameTime)
+        elapsed = time.perf_counter() - start
+        return len(recording.masks) / elapsed if elapsed > 0 else float("inf")
+
+    def benchmark(self, script, frames):
+        keys = expandInputScript(script, frames)
+        start = time.perf_counter()
+        for i in range(0, frames):
+            self.step(keys[i])
+        elapsed = time.perf_counter() - start
+        return frames / elapsed if elapsed > 0 else float("inf")
+
+
+def expandInputScript(script, frames):
+    keys = []
+    while len(keys) < frames:
+        for count, held in script:
+            keys.extend([held] * count)
+    return keys[:frames]
+
+
+HEADLESS_SCRIPT = [
+    (60, (SDL_SCANCODE_RIGHT,)),
+    (15, (SDL_SCANCODE_RIGHT, SDL_SCANCODE_Z)),
+    (40, ()),
+    (80, (SDL_SCANCODE_LEFT,)),
+    (10, (SDL_SCANCODE_Z,)),
+    (45, (SDL_SCANCODE_LEFT, SDL_SCANCODE_Z)),
+    (50, ()),
+]
 
 class Input(object):
     def __init__(self):
@@ -662,6 +3183,34 @@ class Input(object):
         self._pressedKeys[event.key.keysym.scancode] = True
         self._heldKeys[event.key.keysym.scancode] = True
 
+    def setKeys(self, keys):
+        for key, held in self._heldKeys.items():
+            if held and key not in keys:
+                self._releasedKeys[key] = True
+                self._heldKeys[key] = False
+        for key in keys:
+            if not self._heldKeys.get(key, False):
+                self._pressedKeys[key] = True
+                self._heldKeys[key] = True
+
+    #Held keys in the low byte, keys pressed this frame in the high byte, so a press and release within one frame survives
+    def getKeyMask(self, keys = REPLAY_KEYS):
+        mask = 0
+        for bit in range(0, len(keys)):
+            if self._heldKeys.get(keys[bit], False):
+                mask |= 1 << bit
+            if self._pressedKeys.get(keys[bit], False):
+                mask |= 0x100 << bit
+        return mask
+
+    def setKeyMask(self, mask, keys = REPLAY_KEYS):
+        self.setKeys([keys[bit] for bit in range(0, len(keys)) if mask & (1 << bit)])
+        for bit in range(0, len(keys)):
+            if mask & (0x100 << bit):
+                self._pressedKeys[keys[bit]] = True
+                if not mask & (1 << bit):
+                    self._releasedKeys[keys[bit]] = True
+
     def wasKeyPressed(self, key):
         try:
             return self._pressedKeys[key]
@@ -681,4 +3230,178 @@ class Input(object):
             return False
 
 
-game = Game()
+class InputRecording(object):
+    def __init__(self, mapName, frameTime = 1000 / FPS):
+        self.mapName = mapName
+        self.frameTime = frameTime
+        self.masks = array.array("H")
+        self.finalState = None
+
+    def record(self, mask):
+        self.masks.append(mask)
+
+    def finish(self, player):
+        self.finalState = (player._x, player._y, player._dx, player._dy, player._grounded)
+
+    def matches(self, player):
+        if self.finalState is None:
+            return True
+        x, y, dx, dy, grounded = self.finalState
+        return abs(player._x - x) <= REPLAY.TOLERANCE and abs(player._y - y) <= REPLAY.TOLERANCE and \
+            abs(player._dx - dx) <= REPLAY.TOLERANCE and abs(player._dy - dy) <= REPLAY.TOLERANCE and player._grounded == grounded
+
+    def write(self, path):
+        chunks = [REPLAY.HEADER.pack(REPLAY.MAGIC, REPLAY.VERSION, len(self.masks), self.frameTime, self.finalState is not None), _packString(b"", self.mapName)]
+        if self.finalState is not None:
+            chunks.append(REPLAY.FINAL_STATE.pack(*self.finalState))
+        chunks.append(self.masks.tobytes())
+        with open(path, "wb") as f:
+            f.write(b"".join(chunks))
+
+def readInputRecording(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, frames, frameTime, hasFinalState = REPLAY.HEADER.unpack_from(data, 0)
+    if magic != REPLAY.MAGIC or version != REPLAY.VERSION:
+        raise ValueError("Not a version %d input recording: %s" % (REPLAY.VERSION, path))
+    mapName, offset = _unpackString(data, REPLAY.HEADER.size)
+    recording = InputRecording(mapName, frameTime)
+    if hasFinalState:
+        x, y, dx, dy, grounded = REPLAY.FINAL_STATE.unpack_from(data, offset)
+        recording.finalState = (x, y, dx, dy, bool(grounded))
+        offset += REPLAY.FINAL_STATE.size
+    recording.masks.frombytes(data[offset:offset + frames * recording.masks.itemsize])
+    if len(recording.masks) != frames:
+        raise ValueError("Truncated input recording: " + path)
+    return recording
+
+
+def main(argv = None):
+    STARTUP.STARTED = time.perf_counter()
+    parser = argparse.ArgumentParser(description = "Cavestory")
+    parser.add_argument("--headless", action = "store_true", help = "run the simulation without a window and report frames per second")
+    parser.add_argument("--frames", type = int, default = 10000, help = "number of fixed-step frames to simulate in headless mode")
+    parser.add_argument("--collision-benchmark", action = "store_true", help = "compare rectangle and attribute-grid tile collision queries on a stage")
+    parser.add_argument("--allocation-check", action = "store_true", help = "fail if steady-state headless frames construct or retain geometry objects")
+    parser.add_argument("--build-pack", action = "store_true", help = "pack data/ and Resources/ into a single memory-mapped asset archive")
+    parser.add_argument("--build-atlas", action = "store_true", help = "pack the NPC and core sprite sheets into a few shared texture atlas pages")
+    parser.add_argument("--verify-pack", action = "store_true", help = "check every asset pack entry against its manifest checksum")
+    parser.add_argument("--profile", action = "store_true", help = "time each frame phase and print rolling percentiles on exit")
+    parser.add_argument("--profile-overlay", action = "store_true", help = "draw per-phase frame time bars over the game (implies --profile)")
+    parser.add_argument("--trace", metavar = "PATH", help = "write a Chrome trace of every profiled phase to PATH on exit (implies --profile)")
+    parser.add_argument("--record", metavar = "PATH", help = "record per-frame input and the final player state to PATH (fixed timestep)")
+    parser.add_argument("--replay", metavar = "PATH", help = "replay a recording headless, report frames per second and check the final player state")
+    parser.add_argument("--vsync", action = "store_true", help = "present with vsync instead of sleeping to the target frame rate")
+    parser.add_argument("--render-fps", type = int, default = FPS, help = "frame rate to pace rendering to, 0 for uncapped")
+    parser.add_argument("--fixed-update", action = "store_true", help = "update at a fixed %d Hz and interpolate drawing between updates" % FPS)
+    parser.add_argument("--preprocess-stages", action = "store_true", help = "validate every stage and precompile its scripts in parallel, skipping unchanged stages")
+    parser.add_argument("--jobs", type = int, help = "worker processes for --preprocess-stages (default: CPU count)")
+    parser.add_argument("--force", action = "store_true", help = "reprocess every stage even if its inputs are unchanged")
+    parser.add_argument("--snapshot-benchmark", action = "store_true", help = "time world snapshot capture and restore and check that a restored run repeats exactly")
+    parser.add_argument("--startup-benchmark", action = "store_true", help = "report import time and time to the first presented frame over several fresh processes")
+    parser.add_argument("--first-frame", action = "store_true", help = "exit after presenting the first frame and print how long it took from main()")
+    parser.add_argument("--map", help = "map to use in headless or benchmark mode")
+    args = parser.parse_args(argv)
+    PROFILE.ENABLED = args.profile or args.profile_overlay or args.trace is not None
+    PROFILE.OVERLAY = args.profile_overlay
+    PROFILE.TRACE_PATH = args.trace
+    REPLAY.RECORD_PATH = args.record
+    LOOP.VSYNC = args.vsync
+    LOOP.RENDER_FPS = args.render_fps or None
+    LOOP.FIXED_UPDATE = args.fixed_update
+    STARTUP.FIRST_FRAME_ONLY = args.first_frame
+
+    if args.build_pack:
+        from packtools import buildAssetPack
+        count, size = buildAssetPack()
+        print("packed %d files (%d bytes) into %s" % (count, size, os.path.normpath(PACK.PATH)))
+    elif args.build_atlas:
+        from packtools import buildAtlas
+        sheets, pages = buildAtlas()
+        print("packed %d sprite sheets into %d %dx%d pages in %s" % (sheets, pages, ATLAS.PAGE_SIZE, ATLAS.PAGE_SIZE, os.path.normpath(ATLAS.PATH)))
+    elif args.verify_pack:
+        pack = getAssetPack()
+        if pack is None:
+            print("no usable asset pack at " + os.path.normpath(PACK.PATH))
+            sys.exit(1)
+        corrupt = pack.verify()
+        print("%d entries, %d corrupt" % (len(pack.getNames()), len(corrupt)))
+        for name in corrupt:
+            print("  " + name)
+        if len(corrupt) > 0:
+            sys.exit(1)
+    elif args.preprocess_stages:
+        from preprocess import preprocessStages
+        stages, results, elapsed = preprocessStages(args.jobs, args.force)
+        workTime = sum(result["ms"] for result in results)
+        print("%d stages, %d processed, %d unchanged in %.0f ms (%.0f ms of work)" % (len(stages), len(results), len(stages) - len(results), elapsed * 1000, workTime))
+        for result in sorted(results, key = lambda result: -result["ms"])[0:5]:
+            print("  %-10s %7.1f ms  %3d entities  %3d events" % (result["stage"], result["ms"], result["entities"], result["events"]))
+        failed = [result for result in results if len(result["errors"]) > 0]
+        for result in failed:
+            print("%s: %s" % (result["stage"], "; ".join(result["errors"])))
+        if len(failed) > 0:
+            sys.exit(1)
+    elif args.snapshot_benchmark:
+        mapName = args.map or "Cave"
+        from benchmarks import benchmarkSnapshots
+        size, captureTime, restoreTime, exact = benchmarkSnapshots(mapName)
+        print("%s: %d byte snapshots, capture %.1f us, restore %.1f us, %d frames of history in %.1f MB, restored run repeats exactly: %s" %
+            (mapName, size, captureTime * 1e6, restoreTime * 1e6, SNAPSHOT.HISTORY, size * SNAPSHOT.HISTORY / (1024 * 1024), exact))
+        if not exact:
+            sys.exit(1)
+    elif args.startup_benchmark:
+        from benchmarks import benchmarkStartup
+        interpreter, imports, firstFrames, processes = benchmarkStartup()
+        print("startup over %d runs (median): interpreter %.1f ms, import cavestory %.1f ms, main() to first frame %.1f ms, whole process %.1f ms" %
+            (STARTUP.RUNS, interpreter * 1000, (imports - interpreter) * 1000, firstFrames, processes * 1000))
+    elif args.collision_benchmark:
+        mapName = args.map or "Cave"
+        from benchmarks import benchmarkTileCollisions
+        rectangleTime, gridTime = benchmarkTileCollisions(mapName)
+        print("%s: checkTileCollisions %.2f us/query, checkTileGridCollisions %.2f us/query" % (mapName, rectangleTime * 1e6, gridTime * 1e6))
+    elif args.allocation_check:
+        mapName = args.map or "Map 1"
+        from benchmarks import ALLOCATION, measureFrameAllocations
+        created, retained = measureFrameAllocations(mapName, ALLOCATION.FRAMES)
+        print("%s: %d geometry objects constructed, %d bytes retained over %d frames" % (mapName, len(created), retained, ALLOCATION.FRAMES))
+        #A few bytes of replaced ints and floats are noise; anything that grows every frame is not
+        if len(created) > 0 or retained > ALLOCATION.RETAINED_LIMIT:
+            print("constructed: " + ", ".join(sorted(set(created))))
+            sys.exit(1)
+    elif args.replay:
+        recording = readInputRecording(args.replay)
+        profiler = FrameProfiler(tracePath = PROFILE.TRACE_PATH) if PROFILE.ENABLED else None
+        game = HeadlessGame(recording.mapName, profiler)
+        fps = game.replay(recording)
+        player = game._player
+        print("%s: %d frames at %.1f ms/step: %.0f simulated frames/s" % (recording.mapName, len(recording.masks), recording.frameTime, fps))
+        print("final player position (%.3f, %.3f) velocity (%.3f, %.3f) grounded %s" % (player._x, player._y, player._dx, player._dy, player._grounded))
+        if profiler is not None:
+            profiler.finish()
+        if not recording.matches(player):
+            print("final state differs from the recording: (%.3f, %.3f) velocity (%.3f, %.3f) grounded %s" % recording.finalState)
+            sys.exit(1)
+    elif args.headless:
+        args.map = args.map or "Map 1"
+        profiler = FrameProfiler(tracePath = PROFILE.TRACE_PATH) if PROFILE.ENABLED else None
+        game = HeadlessGame(args.map, profiler)
+        if REPLAY.RECORD_PATH is not None:
+            game._recording = InputRecording(args.map)
+        fps = game.benchmark(HEADLESS_SCRIPT, args.frames)
+        player = game._player
+        if game._recording is not None:
+            game._recording.finish(player)
+            game._recording.write(REPLAY.RECORD_PATH)
+        print("%d frames at %.1f ms/step: %.0f simulated frames/s" % (args.frames, 1000 / FPS, fps))
+        print("final player position (%.3f, %.3f) velocity (%.3f, %.3f) grounded %s" % (player._x, player._y, player._dx, player._dy, player._grounded))
+        if profiler is not None:
+            profiler.finish()
+    else:
+        game = Game()
+
+
+if __name__ == "__main__":
+    #Register this module as cavestory, so the tool modules importing it share its state instead of running it again
+    sys.modules.setdefault("cavestory", sys.modules[__name__])
+    main()
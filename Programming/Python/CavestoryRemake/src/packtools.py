@@ -0,0 +1,113 @@
+import os
+import struct
+import glob
+import fnmatch
+import zlib
+import numpy as np
+from ctypes import cast, POINTER, c_uint32
+from sdl2 import *
+from cavestory import PACK, ATLAS, assetName, assetChecksum, getAssetPack, loadImageSurface, _packString
+
+
+def buildAssetPack(packPath = PACK.PATH, root = PACK.ROOT, directories = PACK.DIRECTORIES):
+    files = []
+    for directory in directories:
+        for dirPath, dirNames, fileNames in os.walk(os.path.join(root, directory)):
+            dirNames.sort()
+            for fileName in sorted(fileNames):
+                path = os.path.join(dirPath, fileName)
+                files.append((os.path.relpath(path, root).replace(os.sep, "/"), path))
+
+    #Lay the data out first so the manifest can record final offsets
+    manifestSize = sum(PACK.ENTRY.size + 2 + len(name.encode("utf-8")) for name, path in files)
+    offset = PACK.HEADER.size + manifestSize
+    entries = []
+    blobs = []
+    for name, path in files:
+        with open(path, "rb") as f:
+            data = f.read()
+        offset += -offset % PACK.ALIGNMENT
+        entries.append(_packString(PACK.ENTRY.pack(offset, len(data), zlib.crc32(data)), name))
+        blobs.append((offset, data))
+        offset += len(data)
+
+    manifest = b"".join(entries)
+    chunks = [PACK.HEADER.pack(PACK.MAGIC, PACK.VERSION, len(files), len(manifest), zlib.crc32(manifest)), manifest]
+    position = PACK.HEADER.size + len(manifest)
+    for dataOffset, data in blobs:
+        chunks.append(bytes(dataOffset - position))
+        chunks.append(data)
+        position = dataOffset + len(data)
+
+    os.makedirs(os.path.dirname(os.path.abspath(packPath)), exist_ok = True)
+    tempPath = packPath + ".tmp"
+    with open(tempPath, "wb") as f:
+        f.write(b"".join(chunks))
+    os.replace(tempPath, packPath)
+    return len(files), position
+
+def listAtlasSheets():
+    names = set()
+    pack = getAssetPack()
+    for pattern in ATLAS.SHEETS:
+        names.update(assetName(path) for path in glob.glob(os.path.join(PACK.ROOT, pattern)))
+        if pack is not None:
+            names.update(fnmatch.filter(pack.getNames(), pattern))
+    return sorted(names)
+
+def surfacePixels(surface):
+    converted = SDL_ConvertSurfaceFormat(surface, SDL_PIXELFORMAT_ARGB8888, 0)
+    if not converted:
+        raise RuntimeError("Unable to convert surface: " + SDL_GetError().decode("utf-8", "replace"))
+    converted = converted.contents
+    rows = np.ctypeslib.as_array(cast(converted.pixels, POINTER(c_uint32)), (converted.h, converted.pitch // 4))
+    pixels = rows[:, :converted.w].copy()
+    SDL_FreeSurface(converted)
+    return pixels
+
+def packShelves(sizes, pageSize, padding):
+    #Tallest first, so each shelf wastes little height
+    order = sorted(range(0, len(sizes)), key = lambda i: (-sizes[i][1], -sizes[i][0]))
+    placements = [None] * len(sizes)
+    page, x, y, shelfHeight = 0, 0, 0, 0
+    for i in order:
+        width, height = sizes[i][0] + padding, sizes[i][1] + padding
+        if x + width > pageSize:
+            x, y, shelfHeight = 0, y + shelfHeight, 0
+        if y + height > pageSize:
+            page, x, y, shelfHeight = page + 1, 0, 0, 0
+        placements[i] = (page, x, y)
+        x += width
+        shelfHeight = max(shelfHeight, height)
+    return placements, page + 1 if len(sizes) > 0 else 0
+
+def buildAtlas(atlasPath = ATLAS.PATH, pageSize = ATLAS.PAGE_SIZE):
+    sheets = []
+    for name in listAtlasSheets():
+        path = os.path.join(PACK.ROOT, name)
+        surface = loadImageSurface(path)
+        pixels = surfacePixels(surface)
+        SDL_FreeSurface(surface)
+        if pixels.shape[1] + ATLAS.PADDING > pageSize or pixels.shape[0] + ATLAS.PADDING > pageSize:
+            print("%s is larger than an atlas page, leaving it out" % name)
+            continue
+        sheets.append((name, assetChecksum(path), pixels))
+
+    placements, pageCount = packShelves([(pixels.shape[1], pixels.shape[0]) for name, version, pixels in sheets], pageSize, ATLAS.PADDING)
+    pages = np.zeros((pageCount, pageSize, pageSize), dtype = np.uint32)
+    chunks = [ATLAS.HEADER.pack(ATLAS.MAGIC, ATLAS.VERSION, pageSize, pageCount, len(sheets))]
+    for (name, version, pixels), (page, x, y) in zip(sheets, placements):
+        height, width = pixels.shape
+        pages[page, y:y + height, x:x + width] = pixels
+        chunks.append(_packString(ATLAS.SHEET.pack(version, page, x, y, width, height), name))
+    for page in pages:
+        data = zlib.compress(page.tobytes())
+        chunks.append(struct.pack("<I", len(data)))
+        chunks.append(data)
+
+    os.makedirs(os.path.dirname(os.path.abspath(atlasPath)), exist_ok = True)
+    tempPath = atlasPath + ".tmp"
+    with open(tempPath, "wb") as f:
+        f.write(b"".join(chunks))
+    os.replace(tempPath, atlasPath)
+    return len(sheets), pageCount
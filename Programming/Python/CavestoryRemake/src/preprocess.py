@@ -0,0 +1,86 @@
+import os
+import json
+import struct
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from cavestory import STAGE, STAGE_TABLE, STAGE_NUMBERS, STAGE_PREPROCESS, TSC, NPC, assetExists, assetName, assetVersion, listStages, loadStageData, \
+    getNpcTable, loadStageScripts, scriptCache
+
+
+def stageInputs(stageName):
+    tilesetName = STAGE_TABLE[STAGE_NUMBERS[stageName]][1]
+    inputs = [STAGE.DIRECTORY + stageName + ".pxm", STAGE.DIRECTORY + tilesetName + ".pxa", STAGE.DIRECTORY + stageName + ".pxe",
+        TSC.DIRECTORY + "Stage/" + stageName + ".tsc", TSC.DIRECTORY + "Head.tsc", NPC.TABLE_PATH]
+    return [path for path in inputs if assetExists(path)]
+
+def stageFingerprint(stageName):
+    return [STAGE_PREPROCESS.VERSION, TSC.VERSION] + [[assetName(path), assetVersion(path)] for path in stageInputs(stageName)]
+
+def preprocessStage(stageName):
+    start = time.perf_counter()
+    result = {"stage": stageName, "errors": [], "warnings": [], "entities": 0, "events": 0}
+    try:
+        stage = loadStageData(stageName)
+        result["entities"] = len(stage.entities)
+        if len(stage.tiles) > 0 and int(stage.tiles.max()) >= STAGE.TILESET_COLUMNS * STAGE.TILESET_COLUMNS:
+            result["errors"].append("tile index %d is outside the tileset" % int(stage.tiles.max()))
+
+        table = getNpcTable()
+        entities = stage.entities
+        badTypes = np.unique(entities["type"][entities["type"] >= table.count])
+        if len(badTypes) > 0:
+            result["errors"].append("unknown NPC types " + ", ".join(str(t) for t in badTypes.tolist()))
+        outside = np.count_nonzero((entities["x"] >= stage.width) | (entities["y"] >= stage.height))
+        if outside > 0:
+            result["warnings"].append("%d entities placed outside the map" % outside)
+
+        scripts = loadStageScripts(stageName)
+        if len(scripts) > 0:
+            result["events"] = len(scripts[1].events)
+            missing = sorted(set(entities["event"][entities["event"] != 0].tolist()) - set(scripts[0].events) - set(scripts[1].events))
+            if len(missing) > 0:
+                result["warnings"].append("entity events without a script: " + ", ".join(str(e) for e in missing))
+
+    except (OSError, ValueError, struct.error) as e:
+        result["errors"].append(str(e))
+
+    result["ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+def preprocessStages(jobs = None, force = False):
+    manifestPath = STAGE_PREPROCESS.DIRECTORY + "manifest.json"
+    try:
+        with open(manifestPath) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    #Maps with no stage table entry (Cook) are never loaded, as in loadAllStages
+    stages = [stageName for stageName in listStages() if stageName in STAGE_NUMBERS]
+    fingerprints = {stageName: stageFingerprint(stageName) for stageName in stages}
+    pending = [stageName for stageName in stages if force or manifest.get(stageName, {}).get("fingerprint") != fingerprints[stageName] or
+        len(manifest[stageName]["errors"]) > 0 or not scriptCache.isCached("Stage/" + stageName + ".tsc")]
+
+    #Head.tsc is shared by every stage, so compile it once here rather than racing to write it from each worker
+    scriptCache.load("Head.tsc")
+    start = time.perf_counter()
+    results = []
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers = jobs) as executor:
+            results = list(executor.map(preprocessStage, pending))
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        result["fingerprint"] = fingerprints[result["stage"]]
+        manifest[result["stage"]] = result
+    for stageName in list(manifest):
+        if stageName not in fingerprints:
+            del manifest[stageName]
+
+    os.makedirs(STAGE_PREPROCESS.DIRECTORY, exist_ok = True)
+    tempPath = manifestPath + ".tmp"
+    with open(tempPath, "w") as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.replace(tempPath, manifestPath)
+    return stages, results, elapsed
@@ -0,0 +1,9 @@
+import pytest
+from benchmarks import ALLOCATION, measureFrameAllocations
+
+
+@pytest.mark.parametrize("mapName", ["Map 1", "Cave"])
+def test_steadyStateFramesAllocateNothing(mapName):
+    created, retained = measureFrameAllocations(mapName, ALLOCATION.FRAMES)
+    assert created == []
+    assert retained <= ALLOCATION.RETAINED_LIMIT
@@ -0,0 +1,34 @@
+import zlib
+from cavestory import AssetPack
+from packtools import buildAssetPack
+
+
+def test_assetPackRoundTrip(tmp_path):
+    files = {"data/a.bin": bytes(range(256)) * 3, "data/sub/b.txt": b"cave story\n", "data/empty": b""}
+    for name, data in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents = True, exist_ok = True)
+        path.write_bytes(data)
+
+    packPath = str(tmp_path / "assets.pack")
+    count, size = buildAssetPack(packPath, str(tmp_path), ("data",))
+    assert count == len(files)
+    pack = AssetPack(packPath)
+    try:
+        assert sorted(pack.getNames()) == sorted(files)
+        for name, data in files.items():
+            assert bytes(pack.read(name)) == data
+            assert pack.getVersion(name) == zlib.crc32(data)
+        assert pack.verify() == []
+    finally:
+        pack.close()
+
+    #Flip one byte of a.bin's data and the checksum has to catch it
+    raw = bytearray(open(packPath, "rb").read())
+    raw[raw.index(files["data/a.bin"][0:16]) + 5] ^= 0xFF
+    open(packPath, "wb").write(bytes(raw))
+    pack = AssetPack(packPath)
+    try:
+        assert pack.verify() == ["data/a.bin"]
+    finally:
+        pack.close()
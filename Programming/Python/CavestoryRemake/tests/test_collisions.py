@@ -0,0 +1,15 @@
+import random
+import pytest
+from cavestory import Rectangle, Vector2, createLevel
+
+
+@pytest.mark.parametrize("mapName", ["Map 1", "Map 2", "Cave", "Pens1", "Sand"])
+def test_spatialGridMatchesLinearScan(mapName):
+    level = createLevel(mapName, Vector2(100, 100))
+    width, height = level.getPixelWidth(), level.getPixelHeight()
+    rng = random.Random(mapName)
+    for i in range(0, 4000):
+        #Boxes straddle the map edges too, where the grid cells are sparse
+        box = Rectangle(rng.uniform(-64, width), rng.uniform(-64, height), rng.uniform(1, 96), rng.uniform(1, 96))
+        assert level.checkTileCollisions(box) == [rect for rect in level._collisionRects if rect.collidesWith(box)]
+        assert level.checkSlopeCollisions(box) == [slope for slope in level._slopes if slope.collidesWith(box)]
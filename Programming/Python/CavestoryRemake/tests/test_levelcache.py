@@ -0,0 +1,55 @@
+import mmap
+import os
+from cavestory import LEVEL_CACHE, LevelCache, compileTmx, readCompiledLevel
+
+
+def test_levelCacheRoundTrip(tmp_path):
+    level = compileTmx("Map 1.tmx")
+    cachePath = str(tmp_path / "Map 1.lvl")
+    level.write(cachePath)
+    cached = readCompiledLevel(cachePath)
+    try:
+        assert (cached.width, cached.height, cached.tileWidth, cached.tileHeight) == (level.width, level.height, level.tileWidth, level.tileHeight)
+        assert cached.dependencies == level.dependencies
+        assert cached.tilesets == level.tilesets
+        assert cached.spawnPoints == level.spawnPoints
+        assert [list(layer) for layer in cached.layers] == [layer.tolist() for layer in level.layers]
+        assert list(cached.collisionRects) == level.collisionRects
+        assert list(cached.slopes) == level.slopes
+        assert cached.isCurrent()
+    finally:
+        cached.close()
+
+def test_levelCacheRejectsOtherVersions(tmp_path):
+    cachePath = str(tmp_path / "Map 1.lvl")
+    compileTmx("Map 1.tmx").write(cachePath)
+    with open(cachePath, "r+b") as f:
+        f.seek(4)
+        f.write((LEVEL_CACHE.VERSION + 1).to_bytes(4, "little"))
+    assert readCompiledLevel(cachePath) is None
+
+def test_levelCacheKeepsLevelsOpenWhileAcquired(tmp_path):
+    cache = LevelCache(str(tmp_path) + "/")
+    level = cache.acquire("Map 1")
+    assert cache.acquire("Map 1") is level
+    cache._retire(level)
+    assert len(level.layers) > 0
+    cache.release(level)
+    assert len(level.layers) > 0
+    cache.release(level)
+    assert level.layers == []
+
+def test_rejectedLevelCacheIsUnmapped(tmp_path, monkeypatch):
+    cachePath = str(tmp_path / "Map 1.lvl")
+    compileTmx("Map 1.tmx").write(cachePath)
+    #Cut the last slope short, so the layer views already exist when the read fails
+    with open(cachePath, "r+b") as f:
+        f.truncate(os.path.getsize(cachePath) - 4)
+
+    maps = []
+    class TrackedMap(mmap.mmap):
+        def __init__(self, *args, **kwargs):
+            maps.append(self)
+    monkeypatch.setattr(mmap, "mmap", TrackedMap)
+    assert readCompiledLevel(cachePath) is None
+    assert len(maps) == 1 and maps[0].closed
@@ -0,0 +1,19 @@
+from cavestory import HEADLESS_SCRIPT, HeadlessGame, InputRecording, expandInputScript, readInputRecording
+
+
+def test_replayKeepsTheRecordedFrameTime(tmp_path):
+    frameTime = 1000 / 60
+    game = HeadlessGame("Map 1")
+    game._recording = InputRecording("Map 1", frameTime)
+    for keys in expandInputScript(HEADLESS_SCRIPT, 600):
+        game.step(keys, frameTime)
+    game._recording.finish(game._player)
+    path = str(tmp_path / "Map 1.rec")
+    game._recording.write(path)
+
+    recording = readInputRecording(path)
+    assert recording.frameTime == frameTime
+    assert list(recording.masks) == list(game._recording.masks)
+    replayed = HeadlessGame(recording.mapName)
+    replayed.replay(recording)
+    assert recording.matches(replayed._player)
@@ -0,0 +1,75 @@
+import numpy as np
+import cavestory
+from cavestory import NPC_FLAG, STAGE_ENTITY, TSC, TSC_OPCODES, TSC_TEXT, NpcSystem, ScriptRunner, compileTsc, decodeTsc, getNpcTable, readCompiledScript
+
+
+def encodeTsc(text):
+    #decodeTsc keeps the middle byte as the key, so use the plain byte already there
+    data = bytearray(text)
+    half = len(data) // 2
+    key = data[half]
+    encoded = bytearray((b + key) & 0xFF for b in data)
+    encoded[half] = key
+    return bytes(encoded)
+
+def test_tscDecodeAndCompile(tmp_path):
+    text = b"#0090\r\n<MNA<CMU0008<FAI0000<END\r\n#0091\r\n<KEY<MSGHello<NOD<CLO<TRA0012:0094:0037:0011\r\n"
+    assert decodeTsc(encodeTsc(text)) == text
+
+    script = compileTsc(text)
+    assert script.events == {90: 0, 91: 6}
+    assert list(script.code) == [TSC_OPCODES["MNA"], TSC_OPCODES["CMU"], 8, TSC_OPCODES["FAI"], 0, TSC_OPCODES["END"],
+        TSC_OPCODES["KEY"], TSC_OPCODES["MSG"], TSC_TEXT, 0, TSC_OPCODES["NOD"], TSC_OPCODES["CLO"], TSC_OPCODES["TRA"], 12, 94, 37, 11]
+    assert script.strings == [b"Hello"]
+
+    cachePath = str(tmp_path / "Test.tsb")
+    script.write(cachePath, 1234)
+    cached = readCompiledScript(cachePath, 1234)
+    assert cached.events == script.events
+    assert cached.code == script.code
+    assert cached.strings == script.strings
+    assert readCompiledScript(cachePath, 1235) is None
+
+def test_shippedScriptsCompile():
+    for scriptPath in ("Head.tsc", "Stage/Cave.tsc"):
+        script = cavestory.scriptCache.load(scriptPath)
+        assert len(script.events) > 0
+
+def test_scriptRunnerFlagsAndTransfer():
+    script = compileTsc(b"#0100\r\n<FL+0042<FLJ0042:0101<END\r\n#0101\r\n<KEY<NOD<TRA0012:0094:0037:0011\r\n#0102\r\n<FL+0043<ESC<FL+0044\r\n")
+    transfers = []
+    runner = ScriptRunner([script])
+    runner.onTransfer = lambda *arguments: transfers.append(arguments)
+
+    assert runner.startEvent(100)
+    runner.update()
+    assert runner.getFlag(42)
+    assert runner.isInputLocked() and runner.isWaitingForKey()
+    runner.resume()
+    runner.update()
+    assert not runner.isRunning()
+    assert transfers == [(12, 94, 37, 11)]
+
+    runner.startEvent(102)
+    runner.update()
+    assert runner.getFlag(43) and not runner.getFlag(44)
+    assert not runner.isRunning()
+
+
+def test_stageEntitiesFollowFlags():
+    table = getNpcTable()
+    entities = np.zeros(4, dtype = STAGE_ENTITY)
+    entities["type"] = 1
+    entities["flag"] = [10, 10, 11, TSC.FLAG_COUNT + 5]
+    entities["bits"] = [NPC_FLAG.APPEAR_WHEN_FLAG_SET, NPC_FLAG.HIDE_WHEN_FLAG_SET, 0, NPC_FLAG.APPEAR_WHEN_FLAG_SET]
+    flags = bytearray(TSC.FLAG_COUNT // 8)
+
+    npcs = NpcSystem(table)
+    npcs.spawnStageEntities(entities, flags)
+    assert npcs._flag[0:npcs._count].tolist() == [10, 11]
+
+    flags[10 // 8] |= 1 << (10 % 8)
+    npcs = NpcSystem(table)
+    npcs.spawnStageEntities(entities, flags)
+    assert npcs._flag[0:npcs._count].tolist() == [10, 11]
+    assert npcs._bits[0] & NPC_FLAG.APPEAR_WHEN_FLAG_SET
@@ -0,0 +1,29 @@
+import base64
+import gzip
+import zlib
+import numpy as np
+import pytest
+import untangle
+from cavestory import TMX, decodeTmxLayer
+
+
+def tmxData(attributes, cdata):
+    return untangle.parse("<layer><data%s>%s</data></layer>" % (attributes, cdata)).layer.data
+
+def test_tmxLayerEncodings():
+    gids = np.array([0, 1, 2, 0x80000003, 40, 0, 7, 0x40000001], dtype = np.uint32)
+    expected = (gids & TMX.GID_MASK).tolist()
+    raw = gids.astype("<u4").tobytes()
+    layers = [
+        ("", "".join('<tile gid="%d"/>' % gid if gid else "<tile/>" for gid in gids.tolist())),
+        (' encoding="csv"', "\n" + ",\n".join(str(gid) for gid in gids.tolist()) + "\n"),
+        (' encoding="base64"', base64.b64encode(raw).decode("ascii")),
+        (' encoding="base64" compression="zlib"', base64.b64encode(zlib.compress(raw)).decode("ascii")),
+        (' encoding="base64" compression="gzip"', base64.b64encode(gzip.compress(raw)).decode("ascii")),
+    ]
+    for attributes, cdata in layers:
+        assert decodeTmxLayer(tmxData(attributes, cdata), len(gids)).tolist() == expected
+
+def test_tmxLayerRejectsWrongSize():
+    with pytest.raises(ValueError):
+        decodeTmxLayer(tmxData(' encoding="csv"', "1,2,3"), 4)